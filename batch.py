@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from council import CouncilConfig, Tribe, hedge_stats, output_budgets, the_king, tribes_council
+
+
+# Function to read problems from a JSONL or CSV file into (id, row) pairs
+def load_problems(path, id_column="id"):
+    if path.endswith(".csv"):
+        frame = pd.read_csv(path, dtype=str, keep_default_na=False)
+    else:
+        frame = pd.read_json(path, lines=True, dtype=False)
+    rows = frame.to_dict(orient="records")
+    return [(str(row.get(id_column, i)), row) for i, row in enumerate(rows)]
+
+# Function to collect ids that already finished in an earlier run of the same output file
+def finished_ids(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "error" not in record:
+                done.add(record["id"])
+    return done
+
+# Function to run one problem row through the council
+def solve(config, args, row):
+    if args.tribes:
+        tribes = [Tribe(name, models, row[f"problem_{name.split()[0].lower()}"]) for name, models in args.tribes]
+        return tribes_council(config, tribes)
+    return the_king(config, row[args.problem_column])
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run a file of problem statements through the King and his Peasants.")
+    parser.add_argument("input", help="JSONL or CSV file with one problem per row")
+    parser.add_argument("output", help="JSONL file results are appended to, an existing file is resumed")
+    parser.add_argument("--king", required=True, help="King model")
+    parser.add_argument("--peasants", default="", help="Comma separated peasant models, a repeated model is asked again for a separate answer")
+    parser.add_argument("--water-models", default="", help="Comma separated Water Tribe models, switches to the tribe council")
+    parser.add_argument("--earth-models", default="", help="Comma separated Earth Tribe models")
+    parser.add_argument("--tribe", action="append", default=[], help="A tribe as \"Name:model1,model2\", may be repeated; its problem is read from problem_<first word of the name in lower case>")
+    parser.add_argument("--problem-column", default="problem", help="Column holding the problem statement")
+    parser.add_argument("--id-column", default="id", help="Column holding a stable row id, the row number is used when missing")
+    parser.add_argument("--concurrency", type=int, default=8, help="Problems worked on at the same time")
+    parser.add_argument("--no-cache", action="store_true", help="Do not reuse cached answers")
+    parser.add_argument("--pipeline-king", action="store_true", help="Tribe council: rule on each tribe as soon as it answered, then combine")
+    parser.add_argument("--max-calls", type=int, default=0, help="Model calls in flight at once within one problem, 0 only keeps each provider's limit")
+    parser.add_argument("--group-size", type=int, default=0, help="Let sub-Kings condense groups of this many answers before the King reads them")
+    parser.add_argument("--sub-king", default="llama3-8b-8192", help="Model used by the sub-Kings")
+    parser.add_argument("--route", action="store_true", help="Swap models that miss the latency or cost target for an equivalent one")
+    parser.add_argument("--latency-target", type=float, default=0, help="p95 seconds above which --route swaps a model")
+    parser.add_argument("--cost-target", type=float, default=0, help="Dollars per million output tokens above which --route swaps a model")
+    parser.add_argument("--fallback-king", default="", help="Model that rules on the gathered answers if the King's model fails")
+    parser.add_argument("--failover-peasants", action="store_true", help="Let a peasant whose provider or model is down ask an equivalent model")
+    parser.add_argument("--incremental-king", action="store_true", help="Let the King draft from the first answers and fold in the rest as they arrive")
+    parser.add_argument("--hedge", action="store_true", help="Race a duplicate call against peasants slower than their model's p95")
+    parser.add_argument("--peasant-max-tokens", type=int, default=output_budgets["peasant"], help="Tokens a peasant may write, 0 leaves it to the provider")
+    parser.add_argument("--king-max-tokens", type=int, default=output_budgets["king"], help="Tokens the King may write, 0 leaves it to the provider")
+    parser.add_argument("--compact-answers", action="store_true", help="Let peasants answer with a short JSON verdict, key points and confidence instead of prose")
+    args = parser.parse_args(argv)
+    args.peasants = [m for m in args.peasants.split(",") if m]
+    args.water_models = [m for m in args.water_models.split(",") if m]
+    args.earth_models = [m for m in args.earth_models.split(",") if m]
+    if args.water_models and not args.earth_models:
+        parser.error("--earth-models is required with --water-models")
+    args.tribes = [("Water Tribe", args.water_models), ("Earth Tribe", args.earth_models)] if args.water_models else []
+    for tribe in args.tribe:
+        name, _, models = tribe.partition(":")
+        if not (name.strip() and models):
+            parser.error(f"--tribe {tribe!r} is not \"Name:model1,model2\"")
+        args.tribes.append((name.strip(), [m for m in models.split(",") if m]))
+    if len({name for name, models in args.tribes}) < len(args.tribes):
+        parser.error("every tribe needs its own name")
+    if not (args.peasants or args.tribes):
+        parser.error("pick --peasants, --tribe or --water-models/--earth-models")
+    return args
+
+def main(argv=None):
+    load_dotenv()
+    args = parse_args(argv)
+    config = CouncilConfig(
+        king_model=args.king,
+        peasant_models=args.peasants,
+        openai_api_key=os.environ.get("OPENAI_API_KEY", ""),
+        groq_api_key=os.environ.get("GROQ_API_KEY", ""),
+        use_cache=not args.no_cache,
+        hedge=args.hedge,
+        output_budgets={**output_budgets, "peasant": args.peasant_max_tokens, "king": args.king_max_tokens},
+        compact_answers=args.compact_answers,
+        incremental_king=args.incremental_king,
+        route_models=args.route,
+        latency_target=args.latency_target,
+        cost_target=args.cost_target,
+        fallback_king_model=args.fallback_king,
+        failover_peasants=args.failover_peasants,
+        pipeline_king=args.pipeline_king,
+        max_calls=args.max_calls,
+        group_size=args.group_size,
+        sub_king_model=args.sub_king,
+    )
+
+    problems = load_problems(args.input, args.id_column)
+    done = finished_ids(args.output)
+    todo = [(problem_id, row) for problem_id, row in problems if problem_id not in done]
+    print(f"{len(problems)} problems, {len(problems) - len(todo)} already finished, {len(todo)} to run", file=sys.stderr)
+
+    # Each result is written and flushed as soon as its problem finishes, so a killed run can resume
+    failures = 0
+    start = time.perf_counter()
+    with open(args.output, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = {pool.submit(solve, config, args, row): (problem_id, row) for problem_id, row in todo}
+        for n, future in enumerate(as_completed(futures), 1):
+            problem_id, row = futures[future]
+            record = {"id": problem_id, "input": row}
+            try:
+                result = future.result()
+                record.update(answers=result.answers, verdict=result.verdict, timings=result.timings, errors=result.errors, late=result.late, failovers=result.failovers, spans=result.spans)
+            except Exception as e:
+                failures += 1
+                record["error"] = f"{type(e).__name__}: {e}"
+            out.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            out.flush()
+            print(f"[{n}/{len(todo)}] {problem_id} {'failed' if 'error' in record else 'done'}", file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    print(f"Finished {len(todo)} problems in {elapsed:.1f}s, {failures} failed", file=sys.stderr)
+    if hedge_stats["calls"]:
+        print(f"Hedged {hedge_stats['hedged']} of {hedge_stats['calls']} peasant calls, {hedge_stats['hedge_won']} won by the duplicate", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
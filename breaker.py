@@ -0,0 +1,73 @@
+import threading
+import time
+
+# A model's circuit opens after failures back-to-back failed attempts, its provider's after provider_failures,
+# and refuses calls for cooldown seconds, then lets one probe through (half-open): its success closes the
+# circuit, its failure opens it again, and a probe that never reports back just lets the next one through after another cooldown
+breaker_settings = {"failures": 5, "provider_failures": 10, "cooldown": 30.0}
+
+
+# Raised instead of calling a provider or model whose circuit is open
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_in):
+        super().__init__(f"{name} is failing, not calling it for another {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+# One circuit per provider and one per "provider/model", shared by the whole process
+# A call needs both its provider's and its model's circuit closed, or to be their probe
+class CircuitBreaker:
+    def __init__(self, settings):
+        self.settings = settings
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def _circuit(self, name):
+        if name not in self._circuits:
+            self._circuits[name] = {"failures": 0, "opened": None, "half_open": False}
+        return self._circuits[name]
+
+    def _allows(self, circuit, now):
+        return circuit["opened"] is None or now - circuit["opened"] >= self.settings["cooldown"]
+
+    def allows(self, provider, model):
+        with self._lock:
+            now = time.monotonic()
+            return all(self._allows(self._circuit(name), now) for name in (provider, f"{provider}/{model}"))
+
+    # Raises CircuitOpenError when the call must not be made, otherwise lets it through (as the probe when the cooldown is over)
+    def check(self, provider, model):
+        with self._lock:
+            now = time.monotonic()
+            circuits = [(name, self._circuit(name)) for name in (provider, f"{provider}/{model}")]
+            for name, circuit in circuits:
+                if not self._allows(circuit, now):
+                    retry_in = max(0.0, circuit["opened"] + self.settings["cooldown"] - now)
+                    raise CircuitOpenError(name, retry_in)
+            for name, circuit in circuits:
+                if circuit["opened"] is not None:
+                    circuit.update(opened=now, half_open=True)
+
+    def record_success(self, provider, model):
+        with self._lock:
+            for name in (provider, f"{provider}/{model}"):
+                self._circuits[name] = {"failures": 0, "opened": None, "half_open": False}
+
+    def record_failure(self, provider, model):
+        with self._lock:
+            now = time.monotonic()
+            for name, limit in ((provider, self.settings["provider_failures"]), (f"{provider}/{model}", self.settings["failures"])):
+                circuit = self._circuit(name)
+                circuit["failures"] += 1
+                if circuit["half_open"] or circuit["failures"] >= limit:
+                    circuit["opened"] = now
+
+    # Names of the circuits that are open or half-open, with the seconds until they let a probe through
+    def open_circuits(self):
+        with self._lock:
+            now = time.monotonic()
+            return {name: max(0.0, circuit["opened"] + self.settings["cooldown"] - now) for name, circuit in self._circuits.items() if circuit["opened"] is not None}
+
+
+circuit_breaker = CircuitBreaker(breaker_settings)
@@ -0,0 +1,99 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+# Context window of each model in tokens
+context_windows = {
+    "gpt-4-turbo": 128000,
+    "gpt-4-0125-preview": 128000,
+    "gpt-3.5-turbo-0125": 16385,
+    "gpt-3.5-turbo-instruct": 4096,
+    "llama3-8b-8192": 8192,
+    "gemma-7b-it": 8192,
+    "llama3-70b-8192": 8192,
+    "mixtral-8x7b-32768": 32768,
+}
+
+# Tokens kept free for the King's answer, and a safety margin for the rough token count
+reserved_output = 1024
+margin = 0.9
+
+
+# Function to count tokens the same rough way the rate limiter does, about four characters per token
+def count_tokens(text):
+    return len(text) // 4 + 1
+
+# Function to get the tokens left for peasant answers once the prompt frame and the answer are accounted for
+# reserved is the King's output budget when he has one, reserved_output otherwise
+def king_budget(model, fixed_text, reserved=None):
+    window = context_windows.get(model, 8192)
+    return int((window - (reserved or reserved_output)) * margin) - count_tokens(fixed_text)
+
+# Function to count what the answers cost inside the King prompt, names and separators included
+def answers_tokens(answers):
+    return sum(count_tokens(f"{name}: {advice}\n\n") for name, advice in answers.items())
+
+# Function to drop paragraphs that an earlier peasant already said word for word
+def dedupe_paragraphs(answers):
+    seen = set()
+    result = {}
+    for name, advice in answers.items():
+        kept = []
+        for paragraph in advice.split("\n\n"):
+            key = re.sub(r"\W+", " ", paragraph).strip().lower()
+            if key and key in seen:
+                continue
+            seen.add(key)
+            kept.append(paragraph)
+        result[name] = "\n\n".join(kept)
+    return result
+
+# Function to split the budget fairly: short answers keep their size, the rest share what is left equally
+def fair_shares(sizes, budget):
+    shares = {}
+    remaining = dict(sizes)
+    left = budget
+    while remaining:
+        share = left // len(remaining)
+        small = {name: size for name, size in remaining.items() if size <= share}
+        if not small:
+            shares.update({name: share for name in remaining})
+            break
+        for name, size in small.items():
+            shares[name] = size
+            left -= size
+            del remaining[name]
+    return shares
+
+# Function to cut an answer down to about tokens tokens
+def truncate(advice, tokens):
+    limit = max(0, tokens * 4 - 8)
+    if len(advice) <= limit:
+        return advice
+    return advice[:limit].rstrip() + " [...]"
+
+# Function to fit peasant answers into a token budget, returns the answers and how they were compacted
+# Deduplication comes first, then summarize(advice, tokens) for long answers when given, then truncation
+def fit_answers(answers, budget, summarize=None):
+    if answers_tokens(answers) <= budget:
+        return answers, None
+    answers = dedupe_paragraphs(answers)
+    if answers_tokens(answers) <= budget:
+        return answers, "deduplicated"
+    overhead = {name: count_tokens(f"{name}: \n\n") for name in answers}
+    sizes = {name: count_tokens(advice) for name, advice in answers.items()}
+    shares = fair_shares(sizes, max(0, budget - sum(overhead.values())))
+    method = "truncated"
+    if summarize is not None:
+        # A summary that fails falls back to truncating the original answer
+        def shorten(name):
+            try:
+                return summarize(answers[name], shares[name])
+            except Exception:
+                return answers[name]
+
+        long = [name for name in answers if sizes[name] > shares[name]]
+        with ThreadPoolExecutor(max_workers=max(1, len(long))) as pool:
+            summaries = dict(zip(long, pool.map(shorten, long)))
+        answers = {name: summaries.get(name, advice) for name, advice in answers.items()}
+        method = "summarized"
+    return {name: truncate(advice, shares[name]) for name, advice in answers.items()}, method
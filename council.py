@@ -0,0 +1,893 @@
+import json
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field, replace
+
+from breaker import CircuitOpenError, circuit_breaker
+from budget import answers_tokens, fit_answers, king_budget
+from providers import groq_call, groq_stream, openai_call, openai_stream
+from ratelimit import is_retryable
+from router import equivalent_models, pick_model
+from similarity import group_similar
+from scheduler import Node, Workers, run_graph
+from singleflight import SingleFlight
+from stats import model_stats
+from telemetry import Trace, annotate, count
+
+# Available models
+gpt_models = ["gpt-4-turbo", "gpt-4-0125-preview", "gpt-3.5-turbo-0125", "gpt-3.5-turbo-instruct"]
+groq_models = ["llama3-8b-8192", "gemma-7b-it", "llama3-70b-8192", "mixtral-8x7b-32768"]
+
+# Max peasants consulted at the same time per provider
+max_parallel = {"openai": 4, "groq": 4}
+
+# System prompts of the council
+peasant_system = "You are a coder and problem solver expert"
+king_system = "You are a wise and knowledgeable coder and problem solver king who provides thoughtful answers to questions."
+tribe_king_system = "You are a wise king tasked with synthesizing advice from multiple sources to make informed decisions for the realm."
+summary_system = "You condense advice without losing any distinct recommendation."
+sub_king_system = "You are a trusted advisor to the king who condenses the advice of a group of peasants."
+
+# Appended to the peasants' system prompt when compact_answers is on
+compact_instruction = 'Answer only with a JSON object, no other text: {"verdict": "<your answer in one or two sentences>", "key_points": ["<at most five short points>"], "confidence": <0 to 1>}'
+
+# Most tokens each role may write, 0 leaves it to the provider (no limit for OpenAI, 1024 for Groq)
+# A "role/model" entry overrides the role's budget for that model, as "provider/model" does in rate_limits
+output_budgets = {"peasant": 800, "compact_peasant": 300, "king": 1024, "summary": 400, "sub_king": 600}
+
+# What the King answers in a revision pass when the new advice does not change his draft
+revision_marker = "KEEP"
+
+# Process-wide hedging counters: peasant calls made with hedging on, duplicates fired, duplicates that won
+hedge_stats = {"calls": 0, "hedged": 0, "hedge_won": 0}
+_hedge_lock = threading.Lock()
+
+
+# Everything a council run needs, so the engine never reads UI globals
+@dataclass
+class CouncilConfig:
+    king_model: str
+    peasant_models: list = field(default_factory=list)
+    openai_api_key: str = ""
+    groq_api_key: str = ""
+    use_cache: bool = True
+    stream_peasants: bool = False
+    stream_king: bool = False
+    max_parallel: dict = field(default_factory=lambda: dict(max_parallel))
+    # Max model calls in flight for the whole run across providers, 0 for no limit beyond max_parallel
+    max_calls: int = 0
+    peasant_system: str = peasant_system
+    # Output length: tokens per role (see output_budgets) and stop sequences per role, with compact_answers
+    # peasants answer with a short JSON verdict, key points and confidence that the King reads as a few lines
+    output_budgets: dict = field(default_factory=lambda: dict(output_budgets))
+    stop_sequences: dict = field(default_factory=dict)
+    compact_answers: bool = False
+    # Proceed to the King once quorum peasants answered (0 waits for all) or deadline seconds passed (0 waits forever)
+    quorum: int = 0
+    deadline: float = 0
+    # Late peasants are dismissed, or with show_late collected after the verdict
+    show_late: bool = False
+    # Hedging: when a peasant is slower than its model's hedge_percentile latency a duplicate races it
+    # hedge_after is the threshold until a model has enough history, hedge_models maps a model to the duplicate's model
+    hedge: bool = False
+    hedge_percentile: float = 95
+    hedge_after: float = 3.0
+    hedge_models: dict = field(default_factory=dict)
+    # Tribe councils: rule on each tribe as soon as it answered, then combine the rulings
+    pipeline_king: bool = False
+    # Fit peasant answers into the King model's context window, summarizing with summary_model when set
+    compact_king_prompt: bool = True
+    summary_model: str = ""
+    # Large councils: above group_size answers, sub-Kings synthesize groups of that size concurrently,
+    # level after level, and the King reads only their syntheses (0 turns this off)
+    group_size: int = 0
+    sub_king_model: str = "llama3-8b-8192"
+    # Peasants with the same model and prompt share one call, as do identical calls in flight from other
+    # sessions of the process, and near-identical answers
+    # (MinHash similarity at or above similarity_threshold) reach the King once with a vote count
+    share_duplicate_calls: bool = True
+    merge_similar_answers: bool = True
+    similarity_threshold: float = 0.8
+    # Adaptive routing: a peasant or King model whose recent p95 latency is above latency_target seconds, whose
+    # error rate is above max_error_rate or whose price is above cost_target dollars per million output tokens
+    # is swapped for its fastest equivalent that meets them (0 turns a target off)
+    route_models: bool = False
+    latency_target: float = 0
+    max_error_rate: float = 0.2
+    cost_target: float = 0
+    # Incremental King: once draft_after peasants answered he drafts a verdict while the others work, and folds
+    # later answers in with short passes that keep the draft unless the new advice changes it
+    incremental_king: bool = False
+    draft_after: int = 1
+    # Failover: when the King model fails, fallback_king_model rules on the answers already gathered, and with
+    # failover_peasants a peasant whose provider or model is down asks the first equivalent model that is up
+    fallback_king_model: str = ""
+    failover_peasants: bool = False
+    # Collects a span per model call, the_king and tribes_council give every run its own
+    trace: Trace = None
+
+
+# A tribe of peasants working on its own problem, system replaces the peasants' system prompt when set
+@dataclass
+class Tribe:
+    name: str
+    models: list
+    problem: str
+    system: str = ""
+
+
+# Output of one round of peasant calls, late maps peasants that missed the quorum or deadline to their futures
+@dataclass
+class PeasantRound:
+    answers: dict
+    timings: dict
+    errors: dict
+    late: dict
+    hedges: dict = field(default_factory=dict)
+    failovers: dict = field(default_factory=dict)
+
+
+# Output of a run: answers keep the selection order, timings are in seconds
+# For tribe councils answers maps each tribe name to that tribe's answers
+# errors holds the peasants that still failed after retries, they are left out of the King prompt
+# late maps peasants the King did not wait for to their answer, or None when they were dismissed
+# failovers maps peasants, and the King's rulings, that another model answered to that model and the error
+@dataclass
+class CouncilResult:
+    answers: dict
+    verdict: str
+    timings: dict
+    errors: dict = field(default_factory=dict)
+    late: dict = field(default_factory=dict)
+    hedges: dict = field(default_factory=dict)
+    spans: list = field(default_factory=list)
+    failovers: dict = field(default_factory=dict)
+
+
+# Function to tell which provider serves a model
+def provider_for(model):
+    return "openai" if model in gpt_models else "groq"
+
+# Function to tell whether the run has an API key for a model's provider
+def has_key(config, model):
+    return bool(config.openai_api_key if provider_for(model) == "openai" else config.groq_api_key)
+
+# Function to route a list of models, emitting the swaps made, role is "peasant" or "king"
+def route(config, models, role, on_event=None):
+    if not config.route_models:
+        return list(models)
+    emit = on_event or (lambda event, data: None)
+    picks = {}
+    for model in dict.fromkeys(models):
+        picks[model] = pick_model(model, config.latency_target, config.max_error_rate, config.cost_target, lambda candidate: has_key(config, candidate))
+    routes = [{"role": role, "from": model, "to": pick, "reason": reason} for model, (pick, reason) in picks.items() if pick != model]
+    if routes:
+        emit("models_routed", {"routes": routes})
+    return [picks[model][0] for model in models]
+
+# Function to find the first equivalent of a failed model that can be called and whose circuit is closed
+def fallback_model(config, model):
+    for candidate in equivalent_models.get(model, []):
+        if has_key(config, candidate) and circuit_breaker.allows(provider_for(candidate), candidate):
+            return candidate
+    return None
+
+# Function to wrap the event handler so the King's failovers are noted in failovers
+def noting_failovers(on_event, failovers):
+    def noted(event, data):
+        if event == "king_failover":
+            failovers[data["name"]] = {"model": data["fallback"], "error": data["error"]}
+        if on_event is not None:
+            on_event(event, data)
+
+    return noted
+
+# Function to make the semaphores that cap a run's model calls, per provider and with max_calls for all of them
+def call_slots(config):
+    slots = {provider: threading.Semaphore(limit) for provider, limit in config.max_parallel.items()}
+    slots["all"] = threading.Semaphore(config.max_calls) if config.max_calls else nullcontext()
+    return slots
+
+# Function to hold a run's slots for one call of model
+@contextmanager
+def holding(slots, model):
+    with slots["all"], slots[provider_for(model)]:
+        yield
+
+# Function to take a run's slots for one call of model without waiting, returns whether it got them
+def try_hold(slots, model):
+    taken = []
+    for slot in (slots["all"], slots[provider_for(model)]):
+        if not hasattr(slot, "acquire"):
+            continue
+        if not slot.acquire(blocking=False):
+            for held in taken:
+                held.release()
+            return False
+        taken.append(slot)
+    return True
+
+# Function to give back slots taken with try_hold
+def release(slots, model):
+    for slot in (slots["all"], slots[provider_for(model)]):
+        if hasattr(slot, "release"):
+            slot.release()
+
+# Function to make a repeated model's peasants separate samples: they share no call and no cached answer,
+# so merge_answers only counts votes that were really cast
+def sampling(config, models):
+    if len(set(models)) == len(models):
+        return config
+    return replace(config, share_duplicate_calls=False, use_cache=False)
+
+# Function to time one model call of the run, does nothing outside a traced run
+def call_span(config, name, role, model):
+    if config.trace is None:
+        return nullcontext()
+    return config.trace.span(name, role=role, model=model)
+
+# Function to wrap the event handler so the time spent drawing the page shows up in the timings
+def timed_events(on_event, timings):
+    if on_event is None:
+        return None
+
+    def timed(event, data):
+        start = time.perf_counter()
+        try:
+            on_event(event, data)
+        finally:
+            timings["UI"] = timings.get("UI", 0.0) + time.perf_counter() - start
+
+    return timed
+
+# Function to get the max tokens and stop sequences of a role's call to model, None where the provider decides
+def output_limit(config, role, model):
+    budgets = config.output_budgets
+    return budgets.get(f"{role}/{model}", budgets.get(role)) or None, config.stop_sequences.get(role) or None
+
+# Function to tell the output role of the run's peasants
+def peasant_role(config):
+    return "compact_peasant" if config.compact_answers else "peasant"
+
+# Function to get the system prompt of the run's peasants
+def peasant_instructions(config):
+    if config.compact_answers:
+        return f"{config.peasant_system}\n\n{compact_instruction}"
+    return config.peasant_system
+
+# Function to read a compact answer, None when the text holds no JSON object with a verdict
+def parse_compact(text):
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) and data.get("verdict") else None
+
+# Function to turn a compact answer into the few lines the King reads, text that is not one is kept as it is
+def render_compact(text):
+    data = parse_compact(text)
+    if data is None:
+        return text
+    points = data.get("key_points") or []
+    lines = [f"Verdict: {data['verdict']}"] + [f"- {point}" for point in (points if isinstance(points, list) else [points])]
+    if data.get("confidence") is not None:
+        lines.append(f"Confidence: {data['confidence']}")
+    return "\n".join(lines)
+
+# Function to call a model of either provider, role picks its output budget and stop sequences
+def call_model(config, model, prompt, system_message, role="peasant"):
+    max_tokens, stop = output_limit(config, role, model)
+    if model in gpt_models:
+        return openai_call(prompt, model, system_message, config.openai_api_key, use_cache=config.use_cache, coalesce=config.share_duplicate_calls, max_tokens=max_tokens, stop=stop)
+    return groq_call(prompt, model, config.groq_api_key, use_cache=config.use_cache, coalesce=config.share_duplicate_calls, system_message=system_message, max_tokens=max_tokens, stop=stop)
+
+# Function to stream a model of either provider as text chunks
+def stream_model(config, model, prompt, system_message, role="peasant"):
+    max_tokens, stop = output_limit(config, role, model)
+    if model in gpt_models:
+        return openai_stream(prompt, model, system_message, config.openai_api_key, use_cache=config.use_cache, coalesce=config.share_duplicate_calls, max_tokens=max_tokens, stop=stop)
+    return groq_stream(prompt, model, config.groq_api_key, use_cache=config.use_cache, coalesce=config.share_duplicate_calls, system_message=system_message, max_tokens=max_tokens, stop=stop)
+
+# Function to stream a model into a string, giving up and closing the connection once cancelled is set
+def collect_answer(config, model, prompt, system_message, cancelled, name="", role="peasant"):
+    with call_span(config, name, "hedge", model):
+        text = ""
+        chunks = stream_model(config, model, prompt, system_message, role)
+        for chunk in chunks:
+            if cancelled.is_set():
+                chunks.close()
+                annotate(cancelled=True)
+                return None
+            text += chunk
+        return text.strip()
+
+# Function to ask a model, firing a duplicate at the hedge model if no answer came within the threshold
+# The first answer wins and the loser is cut off, returns the answer and None or a dict describing the hedge
+# The duplicate holds its own slot of the run, it is only fired once one is free and the primary is still running
+def hedged_call(config, model, prompt, system_message, slots, name="", role="peasant"):
+    # Both attempts must really reach the provider, a duplicate that joined the primary's call would race nothing
+    config = replace(config, share_duplicate_calls=False)
+    threshold = model_stats.percentile(model, config.hedge_percentile) or config.hedge_after
+    backup = config.hedge_models.get(model, model)
+    pool = ThreadPoolExecutor(max_workers=2)
+    try:
+        primary_cancelled = threading.Event()
+        primary = pool.submit(collect_answer, config, model, prompt, system_message, primary_cancelled, f"{name} primary", role)
+        if not wait([primary], timeout=threshold).not_done:
+            return primary.result(), None
+        while not try_hold(slots, backup):
+            if not wait([primary], timeout=0.1).not_done:
+                return primary.result(), None
+        hedge_cancelled = threading.Event()
+        hedge = pool.submit(collect_answer, config, backup, prompt, system_message, hedge_cancelled, f"{name} hedge", role)
+        hedge.add_done_callback(lambda future: release(slots, backup))
+        attempts = {primary: ("primary", primary_cancelled), hedge: ("hedge", hedge_cancelled)}
+        pending = set(attempts)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    answer = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                for loser in pending:
+                    attempts[loser][1].set()
+                return answer, {"model": backup, "after": threshold, "winner": attempts[future][0]}
+        raise error
+    finally:
+        pool.shutdown(wait=False)
+
+# Function to ask one peasant, holding a slot of its provider while the call runs
+# When updates is a queue, the partial answer is pushed to it after every chunk
+# Once dismissed is set the peasant is not started, and a streaming peasant stops reading and returns no answer
+# With compact_answers the answer is returned as the lines the King reads
+def answer_peasant(config, i, name, model, prompt, slots, updates=None, dismissed=None):
+    system_message, role = peasant_instructions(config), peasant_role(config)
+    with call_span(config, name, "peasant", model):
+        waited = time.perf_counter()
+        with holding(slots, model):
+            count(queue_wait=time.perf_counter() - waited)
+            start = time.perf_counter()
+            if dismissed is not None and dismissed.is_set():
+                annotate(dismissed=True)
+                return None, 0.0, None
+            hedge = None
+            if updates is None and config.hedge:
+                answer, hedge = hedged_call(config, model, prompt, system_message, slots, name, role)
+            elif updates is None:
+                answer = call_model(config, model, prompt, system_message, role)
+            else:
+                text = ""
+                chunks = stream_model(config, model, prompt, system_message, role)
+                for chunk in chunks:
+                    # A cut off answer is no answer, so a peasant sharing this call asks for itself
+                    if dismissed is not None and dismissed.is_set():
+                        chunks.close()
+                        annotate(dismissed=True)
+                        return None, time.perf_counter() - start, None
+                    text += chunk
+                    updates.put((i, text))
+                answer = text.strip()
+            if config.compact_answers and answer is not None:
+                answer = render_compact(answer)
+            return answer, time.perf_counter() - start, hedge
+
+# Function to ask one peasant, sharing the call with any other peasant of the run asking the same model the same thing
+def ask_peasant(config, i, name, model, prompt, slots, updates=None, dismissed=None, shared=None):
+    if shared is None:
+        return answer_peasant(config, i, name, model, prompt, slots, updates, dismissed)
+    result = shared.run((model, peasant_instructions(config), prompt), answer_peasant, config, i, name, model, prompt, slots, updates, dismissed)
+    # The shared call was dismissed by another round, so this peasant asks for itself
+    if result[0] is None and not (dismissed is not None and dismissed.is_set()):
+        result = answer_peasant(config, i, name, model, prompt, slots, updates, dismissed)
+    return result
+
+# Function to ask one peasant, turning to an equivalent model when failover_peasants is on and its backend is down
+# Returns the answer, seconds, hedge and None or a dict describing the failover
+def ask_with_failover(config, i, name, model, prompt, slots, updates=None, dismissed=None, shared=None):
+    start = time.perf_counter()
+    try:
+        return ask_peasant(config, i, name, model, prompt, slots, updates, dismissed, shared) + (None,)
+    except Exception as e:
+        backup = fallback_model(config, model) if config.failover_peasants and (isinstance(e, CircuitOpenError) or is_retryable(e)) else None
+        if backup is None:
+            raise
+        error = f"{type(e).__name__}: {e}"
+    answer, seconds, hedge = answer_peasant(config, i, f"{name} via {backup}", backup, prompt, slots, updates, dismissed)
+    return answer, time.perf_counter() - start, hedge, {"model": backup, "error": error}
+
+# Function to consult peasants concurrently, calls is a list of (name, model, prompt)
+# on_event runs on the calling thread, so UIs that are not thread safe can draw from it
+# A failing peasant does not stop the others, it is reported in the returned errors instead
+# The round ends early once the quorum answered, or at the deadline if anyone answered by then
+# shared and slots let several rounds of one run share identical calls and call limits, each round has its own otherwise
+def consult_peasants(config, calls, on_event=None, shared=None, slots=None):
+    emit = on_event or (lambda event, data: None)
+    if shared is None and config.share_duplicate_calls:
+        shared = SingleFlight()
+    slots = slots or call_slots(config)
+    updates = queue.Queue() if config.stream_peasants else None
+    dismissed = threading.Event()
+    quorum = min(config.quorum, len(calls)) if config.quorum else len(calls)
+    deadline = time.perf_counter() + config.deadline if config.deadline else None
+    results = [None] * len(calls)
+    timings = {}
+    errors = {}
+    hedges = {}
+    failovers = {}
+    pool = ThreadPoolExecutor(max_workers=max(1, len(calls)))
+    try:
+        futures = {pool.submit(ask_with_failover, config, i, name, model, prompt, slots, updates, dismissed, shared): i for i, (name, model, prompt) in enumerate(calls)}
+        pending = set(futures)
+        while pending:
+            answered = len(timings)
+            if answered >= quorum or (deadline is not None and answered and time.perf_counter() >= deadline):
+                break
+            timeout = 0.1 if deadline is None else max(0.0, min(0.1, deadline - time.perf_counter()))
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            while updates is not None and not updates.empty():
+                i, text = updates.get()
+                emit("peasant_chunk", {"index": i, "name": calls[i][0], "text": text})
+            for future in done:
+                i = futures[future]
+                name = calls[i][0]
+                try:
+                    results[i], timings[name], hedge, failover = future.result()
+                except Exception as e:
+                    errors[name] = f"{type(e).__name__}: {e}"
+                    emit("peasant_failed", {"index": i, "name": name, "error": errors[name]})
+                    continue
+                if hedge is not None:
+                    hedges[name] = hedge
+                if failover is not None:
+                    failovers[name] = failover
+                emit("peasant_done", {"index": i, "name": name, "answer": results[i], "hedge": hedge, "failover": failover})
+    finally:
+        # Never block on peasants the King is not waiting for
+        if not config.show_late:
+            dismissed.set()
+        pool.shutdown(wait=False, cancel_futures=not config.show_late)
+    late = {calls[futures[future]][0]: future for future in pending}
+    if late:
+        emit("peasants_late", {"names": list(late)})
+    if config.hedge and not config.stream_peasants:
+        with _hedge_lock:
+            hedge_stats["calls"] += len(timings)
+            hedge_stats["hedged"] += len(hedges)
+            hedge_stats["hedge_won"] += sum(1 for hedge in hedges.values() if hedge["winner"] == "hedge")
+    answers = {name: results[i] for i, (name, model, prompt) in enumerate(calls) if name in timings}
+    return PeasantRound(answers, timings, errors, late, hedges, failovers)
+
+# Function to settle peasants that missed the King, waiting for them only when show_late is on
+def collect_late(config, late, on_event=None):
+    emit = on_event or (lambda event, data: None)
+    if not config.show_late:
+        return {name: None for name in late}
+    names = {future: name for name, future in late.items()}
+    answers = {}
+    for future in as_completed(names):
+        name = names[future]
+        try:
+            answers[name] = future.result()[0]
+        except Exception as e:
+            answers[name] = None
+            emit("peasant_failed", {"name": name, "error": f"{type(e).__name__}: {e}"})
+            continue
+        emit("peasant_late", {"name": name, "answer": answers[name]})
+    return {name: answers[name] for name in late}
+
+# Function to have one model write the King's answer, emitting the text so far while it streams
+def king_call(config, model, name, king_prompt, system_message, emit, section=None):
+    with call_span(config, name, "king", model):
+        if not config.stream_king:
+            return call_model(config, model, king_prompt, system_message, "king")
+        text = ""
+        for chunk in stream_model(config, model, king_prompt, system_message, "king"):
+            text += chunk
+            emit("king_chunk", {"text": text, "section": section})
+        return text.strip()
+
+# Function to get the King's answer, handing the answers already gathered to fallback_king_model if the King fails
+# section tells apart the King's rulings when he gives more than one, None is the final verdict
+def king_verdict(config, king_prompt, system_message, on_event=None, section=None):
+    emit = on_event or (lambda event, data: None)
+    name = f"King on the {section}" if section else "King"
+    try:
+        king_answer = king_call(config, config.king_model, name, king_prompt, system_message, emit, section)
+    except Exception as e:
+        fallback = config.fallback_king_model
+        if not fallback or fallback == config.king_model:
+            raise
+        emit("king_failover", {"name": name, "model": config.king_model, "fallback": fallback, "error": f"{type(e).__name__}: {e}", "section": section})
+        king_answer = king_call(config, fallback, f"{name} via {fallback}", king_prompt, system_message, emit, section)
+    emit("king_done", {"verdict": king_answer, "section": section})
+    return king_answer
+
+# Function to merge near-identical answers, the first of each group speaks for the others with a vote count
+def merge_answers(config, answers, on_event=None):
+    if not config.merge_similar_answers or len(answers) < 2:
+        return answers
+    emit = on_event or (lambda event, data: None)
+    groups = group_similar(answers, config.similarity_threshold)
+    if len(groups) == len(answers):
+        return answers
+    emit("answers_merged", {"groups": [group for group in groups if len(group) > 1]})
+    merged = {}
+    for group in groups:
+        name = group[0]
+        if len(group) > 1:
+            name = f"{name} [{len(group)} votes, also {', '.join(group[1:])}]"
+        merged[name] = answers[group[0]]
+    return merged
+
+# Function to fit peasant answers into what is left of the King's context window
+# build_prompt turns answers into the King prompt, called with no answers it gives the fixed part of the prompt
+# The prompt leaves room for the output budget of role, the King's unless a sub-King reads it
+def budget_answers(config, answers, build_prompt, system_message, on_event=None, model=None, role="king"):
+    if not config.compact_king_prompt:
+        return answers
+    emit = on_event or (lambda event, data: None)
+    # A prompt for the King must also fit his fallback, which may have the smaller window
+    kings = [model] if model else [config.king_model] + ([config.fallback_king_model] if config.fallback_king_model else [])
+    budget = min(king_budget(king, system_message + build_prompt({}), output_limit(config, role, king)[0]) for king in kings)
+
+    def summarize_advice(advice, tokens):
+        prompt = f"Summarize the following advice in at most {max(20, tokens * 3 // 4)} words, keeping every distinct recommendation:\n\n{advice}"
+        with call_span(config, "Summary", "summary", config.summary_model):
+            return call_model(config, config.summary_model, prompt, summary_system, "summary")
+
+    summarize = summarize_advice if config.summary_model else None
+    fitted, method = fit_answers(answers, budget, summarize)
+    if method:
+        emit("king_prompt_compacted", {"method": method, "before": answers_tokens(answers), "after": answers_tokens(fitted), "budget": budget})
+    return fitted
+
+# Function to let a sub-King synthesize one group of answers
+def sub_king(config, answers, user_message, name="Sub-King"):
+    def build_prompt(answers):
+        peasant_answers = "\n\n".join(f"{name}: {advice}" for name, advice in answers.items())
+        return f"Peasants Advice:\n{peasant_answers}\n\nProblem: {user_message}\n\nCombine this advice into one concise synthesis that keeps every distinct recommendation and notes where the peasants disagree."
+
+    king_prompt = build_prompt(budget_answers(config, answers, build_prompt, sub_king_system, model=config.sub_king_model, role="sub_king"))
+    with call_span(config, name, "sub_king", config.sub_king_model):
+        return call_model(config, config.sub_king_model, king_prompt, sub_king_system, "sub_king")
+
+# Function to reduce a large council's answers level by level until the King can read them at once
+# A group whose sub-King fails is passed up as its answers joined together
+def reduce_answers(config, answers, user_message, on_event=None):
+    emit = on_event or (lambda event, data: None)
+    timings = {}
+    level = 0
+    while config.group_size > 1 and len(answers) > config.group_size:
+        level += 1
+        start = time.perf_counter()
+        names = list(answers)
+        groups = [{name: answers[name] for name in names[i:i + config.group_size]} for i in range(0, len(names), config.group_size)]
+        with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            futures = [pool.submit(sub_king, config, group, user_message, f"Sub-King {level}.{k+1}") for k, group in enumerate(groups)]
+        reduced = {}
+        for k, (group, future) in enumerate(zip(groups, futures)):
+            try:
+                reduced[f"Sub-King {level}.{k+1} ({config.sub_king_model})"] = future.result()
+            except Exception as e:
+                emit("peasant_failed", {"name": f"Sub-King {level}.{k+1}", "error": f"{type(e).__name__}: {e}"})
+                reduced[f"Group {level}.{k+1}"] = "\n\n".join(f"{name}: {advice}" for name, advice in group.items())
+        answers = reduced
+        timings[f"Sub-Kings level {level}"] = time.perf_counter() - start
+        emit("sub_kings_done", {"level": level, "answers": answers})
+    return answers, timings
+
+# Function to have the King rule on peasant answers, returns his verdict and the timings of his part
+def rule_on_answers(config, user_message, answers, on_event=None):
+    def build_prompt(answers):
+        return king_prompt_for(user_message, answers)
+
+    king_answers, timings = reduce_answers(config, merge_answers(config, answers, on_event), user_message, on_event)
+    king_prompt = build_prompt(budget_answers(config, king_answers, build_prompt, king_system, on_event))
+
+    king_start = time.perf_counter()
+    king_answer = king_verdict(config, king_prompt, king_system, on_event)
+    timings["King"] = time.perf_counter() - king_start
+    return king_answer, timings
+
+# Function to build the King's prompt for a set of peasant answers
+def king_prompt_for(user_message, answers):
+    peasant_answers = "\n\n".join(f"{name}: {advice}" for name, advice in answers.items())
+    return f"Peasants Advice:\n{peasant_answers}\n\nProblem: {user_message}"
+
+# Function to let the King draft a verdict from the answers that arrived so far, nothing is shown while he writes
+def draft_verdict(config, user_message, answers, emit=None):
+    def build_prompt(answers):
+        return king_prompt_for(user_message, answers)
+
+    king_prompt = build_prompt(budget_answers(config, answers, build_prompt, king_system))
+    with call_span(config, "King draft", "king", config.king_model):
+        return call_model(config, config.king_model, king_prompt, king_system, "king")
+
+# Function to let the King fold new answers into his draft, returns the revised verdict or None to keep the draft
+# Only the final pass is shown while he writes, and only once it is clear he is not keeping the draft
+def revise_verdict(config, user_message, draft, answers, emit=None, final=False):
+    def build_prompt(answers):
+        peasant_answers = "\n\n".join(f"{name}: {advice}" for name, advice in answers.items())
+        return f"Problem: {user_message}\n\nYour draft verdict:\n{draft}\n\nMore Peasants Advice:\n{peasant_answers}\n\nIf this advice does not materially change your draft, answer only {revision_marker}. Otherwise write the full revised verdict."
+
+    king_prompt = build_prompt(budget_answers(config, answers, build_prompt, king_system))
+    emit = emit or (lambda event, data: None)
+    with call_span(config, "King" if final else "King revision", "king", config.king_model):
+        # Models rarely answer with the bare marker, so any reply that starts with it keeps the draft
+        if not (final and config.stream_king):
+            text = call_model(config, config.king_model, king_prompt, king_system, "king")
+        else:
+            text = ""
+            chunks = stream_model(config, config.king_model, king_prompt, king_system, "king")
+            for chunk in chunks:
+                text += chunk
+                if len(text.strip()) < len(revision_marker):
+                    continue
+                if text.strip().startswith(revision_marker):
+                    chunks.close()
+                    break
+                emit("king_chunk", {"text": text, "section": None})
+        if text.strip().startswith(revision_marker):
+            annotate(kept=True)
+            return None
+        return text.strip()
+
+# Function to consult the peasants while the King drafts from the first answers and folds in the rest as they arrive
+# Returns the peasant round, the verdict and the King's timings; the verdict waits only for the last short pass
+# A draft that fails stops the drafting and the King rules on all answers the usual way
+def incremental_ruling(config, user_message, calls, on_event=None):
+    emit = on_event or (lambda event, data: None)
+    arrived = {}
+
+    def note_arrivals(event, data):
+        if event == "peasant_done":
+            arrived[data["name"]] = data["answer"]
+        emit(event, data)
+
+    workers = Workers(note_arrivals, max_workers=2)
+    peasants = None
+    draft = None
+    folded = {}
+    drafting = False
+    speculate = True
+    try:
+        workers.submit(("peasants", None), consult_peasants, config, calls)
+        while peasants is None or drafting:
+            for (kind, answers), future in workers.poll():
+                if kind == "peasants":
+                    peasants = future.result()
+                    continue
+                drafting = False
+                try:
+                    revised = future.result()
+                except Exception as e:
+                    speculate = False
+                    emit("king_draft_failed", {"error": f"{type(e).__name__}: {e}"})
+                    continue
+                folded.update(answers)
+                if revised is not None:
+                    draft = revised
+                emit("king_drafted", {"answers": len(folded), "kind": kind, "kept": revised is None})
+            new = {name: answer for name, answer in arrived.items() if name not in folded}
+            if peasants is not None or drafting or not speculate or not new:
+                continue
+            if draft is None and len(arrived) >= config.draft_after:
+                workers.submit(("draft", new), draft_verdict, config, user_message, new)
+                drafting = True
+            elif draft is not None:
+                workers.submit(("revision", new), revise_verdict, config, user_message, draft, new)
+                drafting = True
+    finally:
+        workers.close()
+
+    if not peasants.answers:
+        raise RuntimeError(f"No peasant answered: {peasants.errors}")
+    emit("peasants_done", {"answers": peasants.answers})
+    king_start = time.perf_counter()
+    new = {name: answer for name, answer in peasants.answers.items() if name not in folded}
+    if draft is None:
+        king_answer, timings = rule_on_answers(config, user_message, peasants.answers, on_event)
+        return peasants, king_answer, timings
+    king_answer = draft
+    if new:
+        try:
+            king_answer = revise_verdict(config, user_message, draft, new, emit, final=True) or draft
+        except Exception as e:
+            emit("king_draft_failed", {"error": f"{type(e).__name__}: {e}"})
+            king_answer, timings = rule_on_answers(config, user_message, peasants.answers, on_event)
+            return peasants, king_answer, timings
+    emit("king_done", {"verdict": king_answer, "section": None})
+    return peasants, king_answer, {"King": time.perf_counter() - king_start}
+
+# Function to consult the King
+def the_king(config, user_message, on_event=None):
+    config = replace(config, trace=Trace())
+    ui_timings = {}
+    king_failovers = {}
+    on_event = timed_events(noting_failovers(on_event, king_failovers), ui_timings)
+    emit = on_event or (lambda event, data: None)
+    config = replace(config, peasant_models=route(config, config.peasant_models, "peasant", on_event), king_model=route(config, [config.king_model], "king", on_event)[0])
+    start = time.perf_counter()
+    calls = [(f"Peasant {i+1} ({model})", model, user_message) for i, model in enumerate(config.peasant_models)]
+    config = sampling(config, config.peasant_models)
+    # Sub-Kings need every answer at once, so a council large enough for them is not ruled on incrementally
+    if config.incremental_king and not (config.group_size > 1 and len(calls) > config.group_size):
+        peasants, king_answer, king_timings = incremental_ruling(config, user_message, calls, on_event)
+    else:
+        peasants = consult_peasants(config, calls, on_event)
+        if not peasants.answers:
+            raise RuntimeError(f"No peasant answered: {peasants.errors}")
+        emit("peasants_done", {"answers": peasants.answers})
+        king_answer, king_timings = rule_on_answers(config, user_message, peasants.answers, on_event)
+    answers, timings, errors = peasants.answers, peasants.timings, peasants.errors
+    timings.update(king_timings)
+    timings["total"] = time.perf_counter() - start
+    late = collect_late(config, peasants.late, on_event)
+    timings.update(ui_timings)
+    return CouncilResult(answers, king_answer, timings, errors, late, peasants.hedges, config.trace.records(), {**peasants.failovers, **king_failovers})
+
+# Function to let the King rule on answers gathered by an earlier run, no peasant is called
+def replay_king(config, user_message, answers, on_event=None):
+    config = replace(config, trace=Trace())
+    ui_timings = {}
+    king_failovers = {}
+    on_event = timed_events(noting_failovers(on_event, king_failovers), ui_timings)
+    config = replace(config, king_model=route(config, [config.king_model], "king", on_event)[0])
+    start = time.perf_counter()
+    king_answer, timings = rule_on_answers(config, user_message, answers, on_event)
+    timings["total"] = time.perf_counter() - start
+    timings.update(ui_timings)
+    return CouncilResult(answers, king_answer, timings, spans=config.trace.records(), failovers=king_failovers)
+
+# Functions to consult the tribes
+def consult_tribe(config, tribe, shared=None, on_event=None, slots=None):
+    calls = [(f"{tribe.name} Peasant {i+1} ({model})", model, tribe.problem) for i, model in enumerate(tribe.models)]
+    config = sampling(replace(config, peasant_system=tribe.system or config.peasant_system), tribe.models)
+    return consult_peasants(config, calls, on_event, shared if config.share_duplicate_calls else None, slots)
+
+# Function to join a tribe's advice for the King
+def tribe_advice(tribe, answers):
+    tribe_answers = "\n\n".join(f"{name}: {advice}" for name, advice in answers.items())
+    return f"""
+    Problem {tribe.name.replace(" Tribe", "")}: {tribe.problem}
+    {tribe.name} Advice:
+    {tribe_answers}
+"""
+
+# King's final analysis of every tribe at once
+def king_analysis(config, tribes, answers, on_event=None):
+    tribe_info = {tribe.name: merge_answers(config, answers.get(tribe.name, {}), on_event) for tribe in tribes}
+
+    def build_prompt(answers):
+        sections = "".join(tribe_advice(tribe, {name: advice for name, advice in answers.items() if name in tribe_info[tribe.name]}) for tribe in tribes)
+        return f"""{sections}
+    Your Majesty, please analyze the advice provided by each tribe on its problem and provide separate conclusions for each problem, as well as a combined assessment of the situation. Evaluate how well each tribe addressed its problem and suggest any additional considerations or a final decree that encompasses insights from all tribes.
+    """
+
+    answers = {name: advice for info in tribe_info.values() for name, advice in info.items()}
+    king_prompt = build_prompt(budget_answers(config, answers, build_prompt, tribe_king_system, on_event))
+    return king_verdict(config, king_prompt, tribe_king_system, on_event)
+
+# King's ruling on a single tribe, used when the King is pipelined
+def tribe_ruling(config, tribe, tribe_info, on_event=None):
+    tribe_info = merge_answers(config, tribe_info, on_event)
+
+    def build_prompt(answers):
+        return f"""{tribe_advice(tribe, answers)}
+    Your Majesty, please analyze the advice provided by the {tribe.name} on its problem and provide a conclusion for it. Evaluate how well the tribe addressed its problem.
+    """
+
+    king_prompt = build_prompt(budget_answers(config, tribe_info, build_prompt, tribe_king_system, on_event))
+    return king_verdict(config, king_prompt, tribe_king_system, on_event, section=tribe.name)
+
+# King's combined assessment built from his rulings on each tribe
+def combined_ruling(config, tribes, rulings, on_event=None):
+    parts = "\n\n".join(f"Problem {tribe.name.replace(' Tribe', '')}: {tribe.problem}\nYour ruling on the {tribe.name}:\n{rulings[tribe.name]}" for tribe in tribes if tribe.name in rulings)
+    king_prompt = f"""
+    {parts}
+
+    Your Majesty, you have ruled on each tribe's problem. Now provide a combined assessment of the situation and suggest any additional considerations or a final decree that encompasses insights from all tribes.
+    """
+    return king_verdict(config, king_prompt, tribe_king_system, on_event)
+
+# Function to get the King's final word on the tribes: with pipeline_king his rulings on each tribe
+# followed by their combined assessment, otherwise one analysis of all tribes
+def tribes_verdict(config, tribes, answers, rulings, on_event=None):
+    if config.pipeline_king:
+        combined = combined_ruling(config, tribes, rulings, on_event)
+        sections = [f"### The King on the {tribe.name}\n\n{rulings[tribe.name]}" for tribe in tribes if tribe.name in rulings]
+        return "\n\n".join(sections + [f"### Combined Assessment\n\n{combined}"])
+    return king_analysis(config, tribes, answers, on_event)
+
+# Function to run a council of any number of tribes as a dependency graph: every tribe's peasants, the King's
+# ruling on each tribe (with pipeline_king) and his final word each start as soon as what they need is done,
+# under the run's per-provider and max_calls limits, so the run costs about its longest chain of calls
+# answers lets the King rule on tribe answers gathered earlier without calling any peasant
+def tribes_council(config, tribes, on_event=None, answers=None):
+    config = replace(config, trace=Trace())
+    ui_timings = {}
+    king_failovers = {}
+    on_event = timed_events(noting_failovers(on_event, king_failovers), ui_timings)
+    emit = on_event or (lambda event, data: None)
+    start = time.perf_counter()
+    config = replace(config, king_model=route(config, [config.king_model], "king", on_event)[0])
+    if answers is None:
+        routed = iter(route(config, [model for tribe in tribes for model in tribe.models], "peasant", on_event))
+        tribes = [replace(tribe, models=[next(routed) for _ in tribe.models]) for tribe in tribes]
+    if len({tribe.name for tribe in tribes}) < len(tribes):
+        raise ValueError("Every tribe needs its own name")
+    slots = call_slots(config)
+    shared = SingleFlight() if config.share_duplicate_calls else None
+    rounds = {}
+    timings = {}
+
+    def consult(tribe):
+        return lambda done, emit: consult_tribe(config, tribe, shared, emit, slots)
+
+    def rule(tribe):
+        def task(done, emit):
+            tribe_answers = rounds[tribe.name].answers if answers is None else answers.get(tribe.name)
+            if not tribe_answers:
+                return None
+            with holding(slots, config.king_model):
+                return tribe_ruling(config, tribe, tribe_answers, emit)
+
+        return task
+
+    def final_word(done, emit):
+        rulings = {key[1]: ruling for key, ruling in done.items() if ruling is not None}
+        tribe_answers = {tribe.name: rounds[tribe.name].answers for tribe in tribes} if answers is None else answers
+        with holding(slots, config.king_model):
+            return tribes_verdict(config, tribes, tribe_answers, rulings, emit)
+
+    nodes = []
+    for tribe in tribes:
+        if answers is None:
+            nodes.append(Node(("tribe", tribe.name), consult(tribe)))
+        if config.pipeline_king:
+            nodes.append(Node(("ruling", tribe.name), rule(tribe), [("tribe", tribe.name)] if answers is None else []))
+    nodes.append(Node(("king", None), final_word, [node.key for node in nodes if node.key[0] == ("ruling" if config.pipeline_king else "tribe")]))
+
+    def on_done(key, result):
+        kind, name = key
+        if kind == "tribe":
+            rounds[name] = result
+            timings.update(result.timings)
+            emit("tribe_done", {"tribe": name, "answers": result.answers})
+            if len(rounds) == len(tribes):
+                tribe_answers = {tribe.name: rounds[tribe.name].answers for tribe in tribes}
+                if not any(tribe_answers.values()):
+                    errors = {peasant: error for peasants in rounds.values() for peasant, error in peasants.errors.items()}
+                    raise RuntimeError(f"No peasant answered: {errors}")
+                emit("peasants_done", {"answers": tribe_answers})
+
+    results, seconds = run_graph(nodes, on_event, on_done)
+    for (kind, name), duration in seconds.items():
+        if kind == "ruling" and results[(kind, name)] is not None:
+            timings[f"King on {name}"] = duration
+    timings["King"] = seconds[("king", None)]
+    timings["total"] = time.perf_counter() - start
+    king_answer = results[("king", None)]
+    if answers is not None:
+        timings.update(ui_timings)
+        return CouncilResult(answers, king_answer, timings, spans=config.trace.records(), failovers=king_failovers)
+    answers = {tribe.name: rounds[tribe.name].answers for tribe in tribes}
+    errors = {name: error for peasants in rounds.values() for name, error in peasants.errors.items()}
+    late = collect_late(config, {name: future for peasants in rounds.values() for name, future in peasants.late.items()}, on_event)
+    hedges = {name: hedge for peasants in rounds.values() for name, hedge in peasants.hedges.items()}
+    failovers = {name: failover for peasants in rounds.values() for name, failover in peasants.failovers.items()}
+    timings.update(ui_timings)
+    return CouncilResult(answers, king_answer, timings, errors, late, hedges, config.trace.records(), {**failovers, **king_failovers})
+
+# Function to let the King rule on tribe answers gathered by an earlier run, no peasant is called
+def replay_tribes(config, tribes, answers, on_event=None):
+    return tribes_council(config, tribes, on_event, answers)
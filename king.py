@@ -1,14 +1,19 @@
+import time
+import uuid
+from dataclasses import asdict
+
 import streamlit as st
-from openai import OpenAI
-from groq import Groq
+
+from breaker import circuit_breaker
+from cache import completion_cache
+from council import CouncilConfig, Tribe, gpt_models, groq_models, hedge_stats, output_budgets, replay_tribes, tribes_council
+from providers import inflight_calls, inflight_streams, warm_up
+from runs import run_store
+from stats import model_stats
 
 # Set custom page configuration
 st.set_page_config(page_title="KING P2", page_icon="👑", layout="wide", initial_sidebar_state="expanded")
 
-# Available models
-gpt_models = ["gpt-4-turbo", "gpt-4-0125-preview", "gpt-3.5-turbo-0125", "gpt-3.5-turbo-instruct"]
-groq_models = ["llama3-8b-8192", "gemma-7b-it", "llama3-70b-8192", "mixtral-8x7b-32768"]
-
 # Page title
 st.title("The Kingdom 2")
 st.write("**A collaborative problem-solving system with a wise King and knowledgeable Tribes.**")
@@ -18,6 +23,21 @@ st.sidebar.write("**PRATIK REDDY**")
 st.sidebar.write("https://twitter.com/pratikredy")
 st.sidebar.write("https://www.youtube.com/@pratik_AI")
 
+# Response cache controls
+use_cache = st.sidebar.checkbox("Reuse cached answers", value=True, help="Skip models whose model, prompt and settings are unchanged since an earlier run")
+if st.sidebar.button("Clear cache"):
+    completion_cache.clear()
+
+# Runs belong to the browser session that made them, other users of the server never see them
+owner = st.session_state.setdefault("owner", uuid.uuid4().hex)
+
+# Past runs of this session, opened from the run store without calling any model
+with st.sidebar.expander("History"):
+    past_runs = {run["id"]: run for run in run_store.recent("tribes", owner)}
+    opened = st.selectbox("Past runs", list(past_runs), index=None, placeholder="Pick a run", format_func=lambda run_id: f"{time.strftime('%b %d %H:%M', time.localtime(past_runs[run_id]['created']))} {past_runs[run_id]['king_model']}: {past_runs[run_id]['title'][:40]}")
+    if st.button("Open run") and opened:
+        st.session_state["run_id"] = opened
+
 # API Key Inputs in collapsible section
 with st.expander("API Keys", expanded=False):
     col1, col2 = st.columns(2)
@@ -29,109 +49,243 @@ with st.expander("API Keys", expanded=False):
 # King Model Selection
 st.subheader("King Model Selection")
 king_model = st.selectbox("Pick your **KING**", gpt_models + groq_models, help="Select the primary (King) model")
-
-# Tribe Model Selection and Problem Statements
-st.subheader("Tribe Model Selection and Problem Statements")
 col1, col2 = st.columns(2)
 with col1:
-    st.write("**Water Tribe**")
-    water_tribe_models = st.multiselect("Select Water Tribe Models", gpt_models + groq_models, help="Select models for Water Tribe")
-    problem_water = st.text_area("Water Tribe Problem", help="Provide the problem for Water Tribe")
+    stream_king = st.checkbox("Stream the King's verdict", value=True, help="Show the verdict token by token as it is written")
 with col2:
-    st.write("**Earth Tribe**")
-    earth_tribe_models = st.multiselect("Select Earth Tribe Models", gpt_models + groq_models, help="Select models for Earth Tribe")
-    problem_earth = st.text_area("Earth Tribe Problem", help="Provide the problem for Earth Tribe")
-
-# Function to call OpenAI API
-def openai_call(messages, model, system_message, api_key):
-    client = OpenAI(api_key=api_key)
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": messages}
-        ],
-        temperature=0.3,
-    )
-    return response.choices[0].message.content.strip()
-
-# Function to call Groq API
-def groq_call(messages, model, api_key):
-    client = Groq(api_key=api_key)
-    system_message = "You are a coder and problem solver expert"
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": messages}
-        ],
-        temperature=0.3,
-        max_tokens=1024,
-    )
-    return response.choices[0].message.content.strip()
-
-# Functions to consult the tribes
-def consult_tribe(tribe_name, tribe_models, problem_statement):
-    answers = {}
-    for i, model in enumerate(tribe_models):
-        st.write(f"{tribe_name} Peasant {i+1} ({model}) is being consulted...")
-        if model in gpt_models:
-            response = openai_call(problem_statement, model, "You are a coder and problem solver expert", openai_api_key)
-        else:
-            response = groq_call(problem_statement, model, groq_api_key)
-        answers[f"{tribe_name} Peasant {i+1} ({model})"] = response
-    return answers
-
-# King's final analysis
-def king_analysis(water_tribe_info, earth_tribe_info, problem_water, problem_earth):
-    st.write("The King is analyzing the contributions from both tribes...")
-    water_answers = "\n\n".join(f"{name}: {advice}" for name, advice in water_tribe_info.items())
-    earth_answers = "\n\n".join(f"{name}: {advice}" for name, advice in earth_tribe_info.items())
-    king_prompt = f"""
-    Problem Water: {problem_water}
-    Water Tribe Advice:
-    {water_answers}
-    
-    Problem Earth: {problem_earth}
-    Earth Tribe Advice:
-    {earth_answers}
-    
-    Your Majesty, please analyze the advice provided by both tribes on their respective problems and provide separate conclusions for each problem, as well as a combined assessment of the situation. Evaluate how well each tribe addressed its problem and suggest any additional considerations or a final decree that encompasses insights from both tribes.
-    """
-
-    if king_model in gpt_models:
-        king_answer = openai_call(king_prompt, king_model, "You are a wise king tasked with synthesizing advice from multiple sources to make informed decisions for the realm.", openai_api_key)
-    else:
-        king_answer = groq_call(king_prompt, king_model, groq_api_key)
+    stream_peasants = st.checkbox("Stream peasant answers", help="Show each peasant's answer live while the tribes deliberate")
+pipeline_king = st.checkbox("Pipeline the King", value=True, help="Let the King rule on each tribe as soon as it has answered, then combine his rulings")
+with st.expander("Quorum, deadline and hedging"):
+    quorum = st.number_input("Quorum", min_value=0, value=0, help="Let the King rule once this many peasants answered, 0 waits for all of them")
+    deadline = st.number_input("Deadline (seconds)", min_value=0.0, value=0.0, step=1.0, help="Let the King rule after this long with whoever answered, 0 means no deadline")
+    show_late = st.checkbox("Show late peasants after the verdict", help="Keep late peasants running and show their answers below the verdict instead of dismissing them")
+    hedge = st.checkbox("Hedge slow peasants", help="If a peasant is slower than its model usually is (p95), ask again and take whichever answer comes first")
+with st.expander("King prompt budget"):
+    compact_king_prompt = st.checkbox("Fit peasant answers into the King's context window", value=True, help="Deduplicate, then summarize or truncate peasant answers when the King prompt would not fit")
+    summary_model = st.selectbox("Summarize long answers with", ["Truncate instead"] + groq_models + gpt_models, help="A fast model that shortens over-long answers in parallel before the King reads them")
+with st.expander("Output length"):
+    peasant_max_tokens = st.number_input("Peasant max tokens", min_value=0, value=output_budgets["peasant"], step=100, help="Cut each peasant's answer at this many tokens, 0 leaves it to the provider")
+    king_max_tokens = st.number_input("King max tokens", min_value=0, value=output_budgets["king"], step=100, help="Cut the King's verdict at this many tokens, 0 leaves it to the provider")
+    compact_answers = st.checkbox("Compact peasant answers", help=f"Peasants answer with a short verdict, key points and a confidence (at most {output_budgets['compact_peasant']} tokens) instead of prose, so they finish sooner and the King reads less")
+with st.expander("Adaptive routing"):
+    route_models = st.checkbox("Route around slow or failing models", help="Swap a model for an equivalent one when its recent latency, error rate or price misses the targets below")
+    latency_target = st.number_input("Latency target (p95 seconds)", min_value=0.0, value=0.0, step=1.0, help="Swap models whose 95th percentile latency is above this, 0 ignores latency")
+    cost_target = st.number_input("Cost target ($ per million output tokens)", min_value=0.0, value=0.0, step=1.0, help="Swap models priced above this, 0 ignores price")
+with st.expander("Failover"):
+    fallback_king_model = st.selectbox("Fallback King", ["None"] + gpt_models + groq_models, help="If the King's model fails, this model rules on the answers already gathered")
+    failover_peasants = st.checkbox("Fail over peasants", help="A peasant whose provider or model is down asks an equivalent model that is up instead")
+
+with st.expander("Call limits"):
+    max_calls = st.number_input("Max calls in flight", min_value=0, value=0, help="Cap the model calls running at once across all tribes and the King, 0 only keeps each provider's own limit")
+
+# Tribe Model Selection and Problem Statements
+st.subheader("Tribe Model Selection and Problem Statements")
+tribe_count = st.number_input("Number of tribes", min_value=1, max_value=12, value=2, help="Every tribe works on its own problem at the same time, the King rules on all of them")
+tribe_names = ["Water Tribe", "Earth Tribe", "Fire Tribe", "Air Tribe"]
+tribe_inputs = []
+for row in range(0, int(tribe_count), 3):
+    for i, col in zip(range(row, min(row + 3, int(tribe_count))), st.columns(3)):
+        with col:
+            name = st.text_input("Tribe name", tribe_names[i] if i < len(tribe_names) else f"Tribe {i+1}", key=f"tribe_name_{i}").strip()
+            models = st.multiselect(f"Select {name} Models", gpt_models + groq_models, key=f"tribe_models_{i}", help=f"Select models for {name}")
+            problem = st.text_area(f"{name} Problem", key=f"tribe_problem_{i}", help=f"Provide the problem for {name}")
+            system = st.text_area(f"{name} System Prompt", key=f"tribe_system_{i}", height=68, help="Optional, replaces the peasants' system prompt for this tribe only")
+            tribe_inputs.append(Tribe(name, models, problem, system.strip()))
+
+# Function to build the event handler that draws the tribes' progress on the page
+def show_progress(tribes):
+    names = [f"{tribe.name} Peasant {i+1} ({model})" for tribe in tribes for i, model in enumerate(tribe.models)]
+    boxes = {name: st.empty() for name in names} if stream_peasants else {}
+    view = {}
+
+    def on_event(event, data):
+        if event == "peasant_chunk":
+            # Routed peasants go by their new model's name
+            if data["name"] not in boxes:
+                boxes[data["name"]] = st.empty()
+            boxes[data["name"]].markdown(f"**{data['name']}** is answering...\n\n{data['text']}")
+        elif event == "peasant_done" and data["hedge"]:
+            info = data["hedge"]
+            st.caption(f"{data['name']} was hedged with {info['model']} after {info['after']:.1f}s, the {info['winner']} answered first.")
+        elif event == "peasant_done" and data["failover"]:
+            st.caption(f"{data['name']} failed ({data['failover']['error']}), {data['failover']['model']} answered instead.")
+        elif event == "king_failover":
+            st.warning(f"{data['model']} could not rule ({data['error']}), {data['fallback']} rules instead.")
+        elif event == "models_routed":
+            for info in data["routes"]:
+                st.caption(f"{info['from']} {info['reason']}, {info['to']} stands in for it as {info['role']}.")
+        elif event == "peasant_failed":
+            st.warning(f"{data['name']} could not answer: {data['error']}")
+        elif event == "king_prompt_compacted":
+            st.caption(f"Peasant answers were {data['method']} from {data['before']} to {data['after']} tokens to fit the King's budget of {data['budget']}.")
+        elif event == "answers_merged":
+            for group in data["groups"]:
+                st.caption(f"{', '.join(group)} gave nearly the same advice, the King reads it once with {len(group)} votes.")
+        elif event == "peasants_late":
+            st.caption(f"The King did not wait for {', '.join(data['names'])}.")
+        elif event == "tribe_done":
+            for name, box in boxes.items():
+                # Peasants are named "<tribe> Peasant n (model)", so "Tribe 1" leaves the boxes of "Tribe 10" alone
+                if name.startswith(f"{data['tribe']} Peasant "):
+                    box.empty()
+
+            # Display outputs from each tribe as soon as it is done
+            st.subheader(f"{data['tribe']} Outputs")
+            for name, advice in data["answers"].items():
+                st.write(f"**{name}**")
+                st.text_area("", advice, height=150, key=name, help=f"Advice from {name}")
+        elif event == "peasants_done":
+            if pipeline_king:
+                st.write("The King is combining his rulings on the tribes...")
+            else:
+                st.write("The King is analyzing the contributions from the tribes...")
+        elif event in ("king_chunk", "king_done"):
+            # Each ruling gets its own area the first time it is written, token by token when streaming
+            section = data["section"]
+            if section not in view:
+                st.subheader(f"The King on the {section}" if section else "King's Verdict")
+                view[section] = st.empty()
+            view[section].markdown(data["text"] if event == "king_chunk" else data["verdict"])
+        elif event == "peasant_late":
+            st.write(f"**{data['name']}** (arrived after the verdict)")
+            st.text_area("", data["answer"], height=150, key=data["name"] + "_late", help=f"Late advice from {data['name']}")
 
-    return king_answer
+    return on_event
 
+# Function to draw a waterfall of the run's model calls: when each one started, queued and finished
+def show_timings(result):
+    # Charting libraries are imported the first time a run is drawn, not on every cold start
+    import altair as alt
+    import pandas as pd
+
+    with st.expander("Timing breakdown"):
+        st.caption(", ".join(f"{name}: {seconds:.2f}s" for name, seconds in result.timings.items()))
+        if not result.spans:
+            return
+        spans = pd.DataFrame(result.spans)
+        for column in ("queue_wait", "ttfb", "ttft", "prompt_tokens", "completion_tokens", "tokens_per_sec", "retries", "cache_hit", "truncated"):
+            if column not in spans:
+                spans[column] = None
+        spans["end"] = spans["start"] + spans["duration"]
+        spans["queued_until"] = spans["start"] + spans["queue_wait"].fillna(0)
+        base = alt.Chart(spans).encode(y=alt.Y("name", sort=None, title=None))
+        calls = base.mark_bar().encode(
+            x=alt.X("start", title="Seconds since the run started"),
+            x2="end",
+            color=alt.Color("role", title="Role"),
+            tooltip=["name", "model", "duration", "queue_wait", "ttfb", "ttft", "prompt_tokens", "completion_tokens", "tokens_per_sec", "retries", "cache_hit", "truncated"],
+        )
+        queued = base.mark_bar(color="lightgray").encode(x="start", x2="queued_until")
+        st.altair_chart(calls + queued)
+        st.dataframe(spans.drop(columns=["trace_id", "end", "queued_until"]), hide_index=True)
+
+# Function to build the council config from the page's settings
+def build_config(king_model):
+    return CouncilConfig(
+        king_model=king_model,
+        openai_api_key=openai_api_key,
+        groq_api_key=groq_api_key,
+        use_cache=use_cache,
+        stream_peasants=stream_peasants,
+        stream_king=stream_king,
+        quorum=int(quorum),
+        deadline=deadline,
+        show_late=show_late,
+        hedge=hedge,
+        compact_king_prompt=compact_king_prompt,
+        summary_model="" if summary_model == "Truncate instead" else summary_model,
+        output_budgets={**output_budgets, "peasant": int(peasant_max_tokens), "king": int(king_max_tokens)},
+        compact_answers=compact_answers,
+        route_models=route_models,
+        latency_target=latency_target,
+        cost_target=cost_target,
+        fallback_king_model="" if fallback_king_model == "None" else fallback_king_model,
+        failover_peasants=failover_peasants,
+        pipeline_king=pipeline_king,
+        max_calls=int(max_calls),
+    )
+
+# Function to draw a stored run again, as it looked when it finished
+def show_run(run):
+    result = run["result"]
+    st.caption(f"Run {run['id']} of {time.strftime('%b %d %H:%M', time.localtime(run['created']))}, {run['king_model']} ruled" + (f" on the answers of run {run['parent']}" if run["parent"] else ""))
+    for tribe in run["inputs"]["tribes"]:
+        st.subheader(f"{tribe['name']} Outputs")
+        st.write(f"**Problem:** {tribe['problem']}")
+        for name, advice in result.answers.get(tribe["name"], {}).items():
+            st.write(f"**{name}**")
+            st.text_area("", advice, height=150, key=name, help=f"Advice from {name}")
+    st.subheader("King's Verdict")
+    st.markdown(result.verdict)
+    for name, answer in result.late.items():
+        if answer is not None:
+            st.write(f"**{name}** (arrived after the verdict)")
+            st.text_area("", answer, height=150, key=name + "_late", help=f"Late advice from {name}")
+    show_timings(result)
 
 # Process the solution
-if st.button("Consult the King"):
-    if not (problem_water and problem_earth):
-        st.warning("Please enter problem statements for both tribes.")
-    elif not (water_tribe_models and earth_tribe_models):
+consult = st.button("Consult the King")
+if consult:
+    if not all(tribe.name for tribe in tribe_inputs) or len({tribe.name for tribe in tribe_inputs}) < len(tribe_inputs):
+        st.error("Please give every tribe its own name.")
+    elif not all(tribe.problem for tribe in tribe_inputs):
+        st.warning("Please enter a problem statement for every tribe.")
+    elif not all(tribe.models for tribe in tribe_inputs):
         st.error("Please select at least one model for each tribe.")
     elif not (openai_api_key and groq_api_key):
         st.error("Please enter valid OpenAI and Groq API keys.")
     else:
         st.info("Summoning the tribes and discussing...")
-        water_tribe_info = consult_tribe("Water Tribe", water_tribe_models, problem_water)
-        earth_tribe_info = consult_tribe("Earth Tribe", earth_tribe_models, problem_earth)
+        config = build_config(king_model)
+        for tribe in tribe_inputs:
+            for i, model in enumerate(tribe.models):
+                st.write(f"{tribe.name} Peasant {i+1} ({model}) is being consulted...")
+        result = tribes_council(config, tribe_inputs, show_progress(tribe_inputs))
+        show_timings(result)
+        tribes = [asdict(tribe) for tribe in tribe_inputs]
+        st.session_state["run_id"] = run_store.save("tribes", config, {"tribes": tribes}, result, owner=owner)
 
-        # Display outputs from each tribe
-        st.subheader("Water Tribe Outputs")
-        for name, advice in water_tribe_info.items():
-            st.write(f"**{name}**")
-            st.text_area("", advice, height=150, key=name + "_water", help=f"Advice from {name}")
+# The session's last run, or one opened from the history, survives reruns and can be replayed
+# into another King, who rules on the stored answers without any peasant being called again
+run = run_store.load(st.session_state["run_id"], owner) if not consult and st.session_state.get("run_id") else None
+if run is not None:
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        replay_model = st.selectbox("Let another King rule on these answers", gpt_models + groq_models, key="replay_king")
+    with col2:
+        replay = st.button("Replay")
+    if replay and not (openai_api_key and groq_api_key):
+        st.error("Please enter valid OpenAI and Groq API keys.")
+    elif replay:
+        config = build_config(replay_model)
+        tribes = [Tribe(**tribe) for tribe in run["inputs"]["tribes"]]
+        # Stored answers are drawn the way a live run draws them, then the King streams below them
+        on_event = show_progress([])
+        for tribe in tribes:
+            on_event("tribe_done", {"tribe": tribe.name, "answers": run["result"].answers.get(tribe.name, {})})
+        on_event("peasants_done", {"answers": run["result"].answers})
+        result = replay_tribes(config, tribes, run["result"].answers, on_event)
+        show_timings(result)
+        st.session_state["run_id"] = run_store.save("tribes", config, run["inputs"], result, parent=run["id"], owner=owner)
+    else:
+        show_run(run)
 
-        st.subheader("Earth Tribe Outputs")
-        for name, advice in earth_tribe_info.items():
-            st.write(f"**{name}**")
-            st.text_area("", advice, height=150, key=name + "_earth", help=f"Advice from {name}")
+# Cache counters, drawn last so they include this run
+cache_stats = completion_cache.stats()
+st.sidebar.caption(f"Cache: {cache_stats['hits']} hits ({cache_stats['disk_hits']} from disk), {cache_stats['misses']} misses, {cache_stats['entries']} answers in memory")
+# Recent latency, error rate and throughput of every model called so far
+routing_stats = {model: model_stats.summary(model, min_samples=1) for model in sorted(model_stats.models())}
+if routing_stats:
+    with st.sidebar.expander("Model latency"):
+        st.dataframe([{"model": model, **summary} for model, summary in routing_stats.items()], hide_index=True)
+open_circuits = circuit_breaker.open_circuits()
+if open_circuits:
+    st.sidebar.caption("Failing fast: " + ", ".join(f"{name} (next try in {seconds:.0f}s)" for name, seconds in open_circuits.items()))
+coalesced = inflight_calls.joined + inflight_streams.joined
+if coalesced:
+    st.sidebar.caption(f"Coalescing: {coalesced} calls joined an identical one already in flight")
+if hedge_stats["calls"]:
+    st.sidebar.caption(f"Hedging: {hedge_stats['hedged']} of {hedge_stats['calls']} peasant calls hedged ({hedge_stats['hedged'] / hedge_stats['calls']:.0%}), {hedge_stats['hedge_won']} won by the duplicate")
 
-        # King's Verdict
-        st.subheader("King's Verdict")
-        king_answer = king_analysis(water_tribe_info, earth_tribe_info, problem_water, problem_earth)
-        st.write(king_answer)
+# The page is drawn, so the provider SDKs can load in the background before the first call needs them
+warm_up()
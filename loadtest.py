@@ -0,0 +1,265 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from mock_server import base_urls, mock_settings, start_server
+from stats import percentile
+
+pages = ["app.py", "main.py", "king.py"]
+
+# What a user of each page fills in before consulting the King, widgets are found by label or by key
+single_king_form = {
+    "OpenAI Key": "mock",
+    "Groq Key": "mock",
+    "Reuse cached answers": False,
+    "Pick your **KING**": "gpt-4-turbo",
+    "Pick your **Peasants**": ["gpt-3.5-turbo-0125", "llama3-8b-8192", "llama3-70b-8192"],
+    "Describe your problem or question": "Load test problem {i}",
+}
+tribes_form = {
+    "OpenAI Key": "mock",
+    "Groq Key": "mock",
+    "Reuse cached answers": False,
+    "Pick your **KING**": "gpt-4-turbo",
+    "tribe_models_0": ["gpt-3.5-turbo-0125", "llama3-8b-8192"],
+    "tribe_problem_0": "Load test problem {i} for the first tribe",
+    "tribe_models_1": ["gemma-7b-it", "llama3-70b-8192"],
+    "tribe_problem_1": "Load test problem {i} for the second tribe",
+}
+forms = {"app.py": single_king_form, "main.py": single_king_form, "king.py": tribes_form}
+
+# Serves one page with Streamlit in its own process, the way it is deployed, but with the providers
+# pointed at the mock and their rate limits lifted so the page itself is what gets measured
+server_script = """
+import sys
+from providers import configure_clients
+from ratelimit import rate_limits, retry_settings
+configure_clients(base_urls=%(base_urls)r)
+for limit in rate_limits.values():
+    limit.update(rpm=10 ** 6, tpm=10 ** 9)
+retry_settings["base_delay"] *= %(time_scale)r
+from streamlit.web import cli
+sys.argv = ["streamlit", "run", %(page)r, "--server.headless=true", "--server.port=%(port)d", "--server.fileWatcherType=none", "--browser.gatherUsageStats=false"]
+sys.exit(cli.main())
+"""
+
+
+# Function to find a free local port for the Streamlit server
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Function to start a page's Streamlit server and wait until it is healthy, returns the process and its port
+def start_page(page, mock_url, time_scale):
+    port = free_port()
+    code = server_script % {"page": page, "port": port, "base_urls": base_urls(mock_url), "time_scale": time_scale}
+    # Sessions save their runs to a throwaway store, so a load test leaves no history behind
+    env = dict(os.environ, KING_RUNS_PATH=":memory:")
+    # The server logs to a file, a pipe nobody reads would fill up and stall it under load
+    log = tempfile.TemporaryFile()
+    process = subprocess.Popen([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=subprocess.DEVNULL, stderr=log)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            log.seek(0)
+            raise RuntimeError(f"{page} did not start:\n{log.read().decode()}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1)
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{page} was not healthy after 60s")
+
+# Thread count and resident memory in bytes of a process, read from /proc
+def process_usage(pid):
+    usage = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name == "Threads":
+                usage["threads"] = int(value)
+            elif name == "VmRSS":
+                usage["memory"] = int(value.split()[0]) * 1024
+    return usage
+
+# Samples the thread count and memory of the server while sessions run
+class Sampler:
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.samples.append(process_usage(self.pid))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def peak(self, key):
+        return max(sample[key] for sample in self.samples)
+
+
+# One browser tab talking to the Streamlit server over its websocket: it asks for reruns with the
+# widget values it set and reads the elements sent back until the script run is finished
+class Session:
+    def __init__(self, socket, timeout):
+        self.socket = socket
+        self.timeout = timeout
+        self.widgets = {}
+        self.error = None
+
+    # Sends a rerun with widget values (widget id -> WidgetState) and waits for the script run to finish
+    def rerun(self, states=()):
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        message = BackMsg()
+        message.rerun_script.query_string = ""
+        message.rerun_script.widget_states.widgets.extend(states)
+        self.socket.send(message.SerializeToString())
+        deadline = time.monotonic() + self.timeout
+        while True:
+            reply = ForwardMsg()
+            reply.ParseFromString(self.socket.recv(timeout=max(0.0, deadline - time.monotonic())))
+            kind = reply.WhichOneof("type")
+            if kind == "script_finished":
+                return
+            if kind == "delta" and reply.delta.WhichOneof("type") == "new_element":
+                self.read_element(reply.delta.new_element)
+
+    def read_element(self, element):
+        from streamlit.proto.Alert_pb2 import Alert
+
+        kind = element.WhichOneof("type")
+        proto = getattr(element, kind)
+        if kind == "exception":
+            self.error = self.error or f"{proto.type}: {proto.message}"
+        elif kind == "alert" and proto.format == Alert.ERROR:
+            self.error = self.error or proto.body
+        elif getattr(proto, "id", "").startswith("$$ID-"):
+            self.widgets[proto.id] = (kind, proto.label)
+
+    # Widget state for the widget labelled or keyed name, holding value
+    def state(self, name, value):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        for widget_id, (kind, label) in self.widgets.items():
+            if label == name or widget_id.endswith(f"-{name}"):
+                break
+        else:
+            raise LookupError(f"No widget labelled or keyed {name!r}")
+        state = WidgetState(id=widget_id)
+        if kind == "checkbox":
+            state.bool_value = value
+        elif kind == "button":
+            state.trigger_value = value
+        elif kind == "multiselect":
+            state.string_array_value.data[:] = value
+        else:
+            state.string_value = value
+        return state
+
+# Function to run one user session: open the page, fill it in and consult the King
+# Returns the seconds the consult took and the error the page showed, if any
+def run_session(port, form, i, timeout):
+    from websockets.sync.client import connect
+
+    try:
+        with connect(f"ws://127.0.0.1:{port}/_stcore/stream", subprotocols=["streamlit"], max_size=None, open_timeout=timeout) as socket:
+            session = Session(socket, timeout)
+            session.rerun()
+            states = [session.state(name, value.format(i=i) if isinstance(value, str) else value) for name, value in form.items()]
+            start = time.perf_counter()
+            session.rerun(states + [session.state("Consult the King", True)])
+            return time.perf_counter() - start, session.error
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+# Function to load one page with many sessions, some open at once, and summarize it
+def run_page(page, mock_url, args):
+    process, port = start_page(page, mock_url, args.time_scale)
+    try:
+        # One session first, so imports and first-time setup are not billed to the load
+        run_session(port, forms[page], -1, args.timeout)
+        idle = process_usage(process.pid)
+        start = time.perf_counter()
+        with Sampler(process.pid) as sampler, ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda i: run_session(port, forms[page], i, args.timeout), range(args.sessions)))
+        wall = time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+    latencies = [seconds for seconds, error in results if error is None]
+    errors = [error for seconds, error in results if error is not None]
+    return {
+        "page": page,
+        "sessions": args.sessions,
+        "concurrency": args.concurrency,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "sessions_per_sec": len(latencies) / wall,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "idle_threads": idle["threads"],
+        "peak_threads": sampler.peak("threads"),
+        "threads_per_session": (sampler.peak("threads") - idle["threads"]) / args.concurrency,
+        "idle_memory_mb": idle["memory"] / 2 ** 20,
+        "peak_memory_mb": sampler.peak("memory") / 2 ** 20,
+        "memory_per_session_mb": max(0, sampler.peak("memory") - idle["memory"]) / 2 ** 20 / args.concurrency,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of the Streamlit pages: many sessions consulting the King at once on one server, against a local mock provider.")
+    parser.add_argument("--page", action="append", choices=pages, help="Page to load, may be repeated (default: all)")
+    parser.add_argument("--sessions", type=int, default=40, help="Sessions per page, each consults the King once")
+    parser.add_argument("--concurrency", type=int, default=10, help="Sessions open at once")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds a session may wait on the server before it fails")
+    parser.add_argument("--time-scale", type=float, default=0.1, help="Multiply the mock's delays by this to keep runs short")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of mock attempts that fail with a 500 or 429")
+    parser.add_argument("--output-tokens", type=int, default=200, help="Tokens in every mock answer")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    mock_settings.update(time_scale=args.time_scale, error_rate=args.error_rate, output_tokens=args.output_tokens, seed=args.seed)
+    server, url = start_server()
+
+    print(f"{'page':<10}{'sessions':>9}{'errors':>8}{'sess/s':>8}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}{'threads':>9}{'thr/sess':>10}{'MB':>7}{'MB/sess':>9}")
+    results = []
+    for page in args.page or pages:
+        result = run_page(page, url, args)
+        results.append(result)
+        cells = "".join(f"{result[key]:>8.3f}" if result[key] is not None else f"{'-':>8}" for key in ("p50", "p95", "p99"))
+        print(f"{page:<10}{result['sessions']:>9}{result['errors']:>8}{result['sessions_per_sec']:>8.2f}{cells}{result['peak_threads']:>9}{result['threads_per_session']:>10.1f}{result['peak_memory_mb']:>7.0f}{result['memory_per_session_mb']:>9.1f}")
+        if result["first_error"]:
+            print(f"  first error: {result['first_error']}")
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,18 @@
+import time
+import uuid
+
 import streamlit as st
-from openai import OpenAI
-from groq import Groq
-from tqdm import tqdm
+
+from breaker import circuit_breaker
+from cache import completion_cache
+from council import CouncilConfig, gpt_models, groq_models, hedge_stats, output_budgets, replay_king, the_king
+from providers import inflight_calls, inflight_streams, warm_up
+from runs import run_store
+from stats import model_stats
 
 # Set custom page configuration
 st.set_page_config(page_title="KING P", page_icon="👑", layout="wide", initial_sidebar_state="expanded")
 
-# Available models
-gpt_models = ["gpt-4-turbo", "gpt-4-0125-preview", "gpt-3.5-turbo-0125", "gpt-3.5-turbo-instruct"]
-groq_models = ["llama3-8b-8192", "gemma-7b-it", "llama3-70b-8192", "mixtral-8x7b-32768"]
-
 # Page title
 st.title("The Kingdom")
 st.write("**A collaborative problem-solving system with a wise King and knowledgeable Peasants.**")
@@ -19,6 +22,21 @@ st.sidebar.write("    **PRATIK REDDY**")
 st.sidebar.write("https://twitter.com/pratikredy")
 st.sidebar.write("https://www.youtube.com/@pratik_AI")
 
+# Response cache controls
+use_cache = st.sidebar.checkbox("Reuse cached answers", value=True, help="Skip models whose model, prompt and settings are unchanged since an earlier run")
+if st.sidebar.button("Clear cache"):
+    completion_cache.clear()
+
+# Runs belong to the browser session that made them, other users of the server never see them
+owner = st.session_state.setdefault("owner", uuid.uuid4().hex)
+
+# Past runs of this session, opened from the run store without calling any model
+with st.sidebar.expander("History"):
+    past_runs = {run["id"]: run for run in run_store.recent("king", owner)}
+    opened = st.selectbox("Past runs", list(past_runs), index=None, placeholder="Pick a run", format_func=lambda run_id: f"{time.strftime('%b %d %H:%M', time.localtime(past_runs[run_id]['created']))} {past_runs[run_id]['king_model']}: {past_runs[run_id]['title'][:40]}")
+    if st.button("Open run") and opened:
+        st.session_state["run_id"] = opened
+
 
 
 
@@ -34,68 +52,180 @@ with col2:
 st.subheader("Model Selection")
 king_model = st.selectbox("Pick your **KING**", gpt_models + groq_models, help="Select the primary (King) model")
 peasant_models = st.multiselect("Pick your **Peasants**", gpt_models + groq_models, help="Select models that will advise the King")
+col1, col2 = st.columns(2)
+with col1:
+    stream_king = st.checkbox("Stream the King's verdict", value=True, help="Show the verdict token by token as it is written")
+with col2:
+    stream_peasants = st.checkbox("Stream peasant answers", help="Show each peasant's answer live while the council deliberates")
+with st.expander("Quorum, deadline and hedging"):
+    quorum = st.number_input("Quorum", min_value=0, value=0, help="Let the King rule once this many peasants answered, 0 waits for all of them")
+    deadline = st.number_input("Deadline (seconds)", min_value=0.0, value=0.0, step=1.0, help="Let the King rule after this long with whoever answered, 0 means no deadline")
+    show_late = st.checkbox("Show late peasants after the verdict", help="Keep late peasants running and show their answers below the verdict instead of dismissing them")
+    hedge = st.checkbox("Hedge slow peasants", help="If a peasant is slower than its model usually is (p95), ask again and take whichever answer comes first")
+    incremental_king = st.checkbox("Let the King draft early", help="The King drafts a verdict from the first answers and folds in later ones with short passes, so the verdict lands soon after the last peasant")
+with st.expander("King prompt budget"):
+    compact_king_prompt = st.checkbox("Fit peasant answers into the King's context window", value=True, help="Deduplicate, then summarize or truncate peasant answers when the King prompt would not fit")
+    summary_model = st.selectbox("Summarize long answers with", ["Truncate instead"] + groq_models + gpt_models, help="A fast model that shortens over-long answers in parallel before the King reads them")
+with st.expander("Output length"):
+    peasant_max_tokens = st.number_input("Peasant max tokens", min_value=0, value=output_budgets["peasant"], step=100, help="Cut each peasant's answer at this many tokens, 0 leaves it to the provider")
+    king_max_tokens = st.number_input("King max tokens", min_value=0, value=output_budgets["king"], step=100, help="Cut the King's verdict at this many tokens, 0 leaves it to the provider")
+    compact_answers = st.checkbox("Compact peasant answers", help=f"Peasants answer with a short verdict, key points and a confidence (at most {output_budgets['compact_peasant']} tokens) instead of prose, so they finish sooner and the King reads less")
+with st.expander("Adaptive routing"):
+    route_models = st.checkbox("Route around slow or failing models", help="Swap a model for an equivalent one when its recent latency, error rate or price misses the targets below")
+    latency_target = st.number_input("Latency target (p95 seconds)", min_value=0.0, value=0.0, step=1.0, help="Swap models whose 95th percentile latency is above this, 0 ignores latency")
+    cost_target = st.number_input("Cost target ($ per million output tokens)", min_value=0.0, value=0.0, step=1.0, help="Swap models priced above this, 0 ignores price")
+with st.expander("Failover"):
+    fallback_king_model = st.selectbox("Fallback King", ["None"] + gpt_models + groq_models, help="If the King's model fails, this model rules on the answers already gathered")
+    failover_peasants = st.checkbox("Fail over peasants", help="A peasant whose provider or model is down asks an equivalent model that is up instead")
+with st.expander("Large councils"):
+    copies = st.number_input("Copies of each peasant", min_value=1, max_value=10, value=1, help="Summon every picked model this many times")
+    group_size = st.number_input("Sub-King group size", min_value=0, value=0, help="Above this many answers, sub-Kings condense groups of this size before the King reads them, 0 turns it off")
+    sub_king_model = st.selectbox("Sub-King model", groq_models + gpt_models, help="A cheap, fast model for the sub-Kings")
 
 # Problem Statement
 st.subheader("Problem Statement")
 problem_statement = st.text_area("Describe your problem or question", help="Provide a detailed problem statement for the King and Peasants to solve")
 
-# Function to call OpenAI API
-def openai_call(messages, model, system_message, api_key):
-    client = OpenAI(api_key=api_key)
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": messages}
-        ],
-        temperature=0.3,
-    )
-    return response.choices[0].message.content.strip()
-
-# Function to call Groq API
-def groq_call(messages, model, api_key):
-    client = Groq(api_key=api_key)
-    system_message = "You are a coder and problem solver expert"
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": messages}
-        ],
-        temperature=0.3,
-        max_tokens=1024,
-    )
-    return response.choices[0].message.content.strip()
+# Function to build the event handler that draws the council's progress on the page
+def show_progress(peasant_models):
+    boxes = [st.empty() for _ in peasant_models] if stream_peasants else []
+    view = {}
 
-# Function to consult the King
-def the_king(king_model, peasant_models, user_message):
-    answers = {}
-    tasks = [f"Consulting Peasant {i+1}" for i in range(len(peasant_models))]
+    def on_event(event, data):
+        if event == "peasant_chunk":
+            boxes[data["index"]].markdown(f"**{data['name']}** is answering...\n\n{data['text']}")
+        elif event == "peasant_done":
+            st.write(f"{data['name']} has answered.")
+            if data["hedge"]:
+                info = data["hedge"]
+                st.caption(f"Hedged with {info['model']} after {info['after']:.1f}s, the {info['winner']} answered first.")
+            if data["failover"]:
+                st.caption(f"Its model failed ({data['failover']['error']}), {data['failover']['model']} answered instead.")
+        elif event == "king_drafted":
+            action = "drafted his verdict from" if data["kind"] == "draft" else "kept his draft after reading" if data["kept"] else "revised his draft after reading"
+            st.caption(f"The King {action} {data['answers']} answers.")
+        elif event == "king_draft_failed":
+            st.caption(f"The King stopped drafting ({data['error']}) and rules on all answers at once.")
+        elif event == "king_failover":
+            st.warning(f"{data['model']} could not rule ({data['error']}), {data['fallback']} rules instead.")
+        elif event == "models_routed":
+            for info in data["routes"]:
+                st.caption(f"{info['from']} {info['reason']}, {info['to']} stands in for it as {info['role']}.")
+        elif event == "peasant_failed":
+            st.warning(f"{data['name']} could not answer: {data['error']}")
+        elif event == "king_prompt_compacted":
+            st.caption(f"Peasant answers were {data['method']} from {data['before']} to {data['after']} tokens to fit the King's budget of {data['budget']}.")
+        elif event == "sub_kings_done":
+            st.caption(f"Sub-Kings of level {data['level']} condensed the advice into {len(data['answers'])} syntheses.")
+        elif event == "answers_merged":
+            for group in data["groups"]:
+                st.caption(f"{', '.join(group)} gave nearly the same advice, the King reads it once with {len(group)} votes.")
+        elif event == "peasants_late":
+            st.caption(f"The King did not wait for {', '.join(data['names'])}.")
+        elif event == "peasants_done":
+            for box in boxes:
+                box.empty()
+            st.write("All Peasants have submitted their due dilligence to the King.")
+            st.write("The King is analyzing the problem...")
 
-    for i, model in enumerate(peasant_models):
-        st.write("The KING has summoned the pesants")
-        st.write(f"Peasant {i+1} is {model}...")
-        if model in gpt_models:
-            answers[f"Peasant {i+1} ({model})"] = openai_call(user_message, model, "You are a coder and problem solver expert", openai_api_key)
-        else:
-            answers[f"Peasant {i+1} ({model})"] = groq_call(user_message, model, groq_api_key)
+            # Display each Peasant's output
+            st.subheader("Peasant Outputs")
+            for name, advice in data["answers"].items():
+                st.write(f"**{name}**")
+                st.text_area("", advice, height=150, key=name, help=f"Advice from {name}")
 
-    peasant_answers = "\n\n".join(f"{name}: {advice}" for name, advice in answers.items())
-    king_prompt = f"Peasants Advice:\n{peasant_answers}\n\nProblem: {user_message}"
+            # King's Verdict is drawn here, token by token when streaming
+            st.subheader("King's Verdict")
+            view["verdict"] = st.empty()
+        elif event == "king_chunk":
+            view["verdict"].markdown(data["text"])
+        elif event == "king_done":
+            view["verdict"].markdown(data["verdict"])
+        elif event == "peasant_late":
+            st.write(f"**{data['name']}** (arrived after the verdict)")
+            st.text_area("", data["answer"], height=150, key=data["name"] + "_late", help=f"Late advice from {data['name']}")
 
-    st.write("All Peasants have submitted their due dilligence to the King.")
-    st.write("The King is analyzing the problem...")
+    return on_event
 
-    if king_model in gpt_models:
-        king_answer = openai_call(king_prompt, king_model, "You are a wise and knowledgeable coder and problem solver king who provides thoughtful answers to questions.", openai_api_key)
-    else:
-        king_answer = groq_call(king_prompt, king_model, groq_api_key)
+# Function to draw a waterfall of the run's model calls: when each one started, queued and finished
+def show_timings(result):
+    # Charting libraries are imported the first time a run is drawn, not on every cold start
+    import altair as alt
+    import pandas as pd
+
+    with st.expander("Timing breakdown"):
+        st.caption(", ".join(f"{name}: {seconds:.2f}s" for name, seconds in result.timings.items()))
+        if not result.spans:
+            return
+        spans = pd.DataFrame(result.spans)
+        for column in ("queue_wait", "ttfb", "ttft", "prompt_tokens", "completion_tokens", "tokens_per_sec", "retries", "cache_hit", "truncated"):
+            if column not in spans:
+                spans[column] = None
+        spans["end"] = spans["start"] + spans["duration"]
+        spans["queued_until"] = spans["start"] + spans["queue_wait"].fillna(0)
+        base = alt.Chart(spans).encode(y=alt.Y("name", sort=None, title=None))
+        calls = base.mark_bar().encode(
+            x=alt.X("start", title="Seconds since the run started"),
+            x2="end",
+            color=alt.Color("role", title="Role"),
+            tooltip=["name", "model", "duration", "queue_wait", "ttfb", "ttft", "prompt_tokens", "completion_tokens", "tokens_per_sec", "retries", "cache_hit", "truncated"],
+        )
+        queued = base.mark_bar(color="lightgray").encode(x="start", x2="queued_until")
+        st.altair_chart(calls + queued)
+        st.dataframe(spans.drop(columns=["trace_id", "end", "queued_until"]), hide_index=True)
+
+# Function to build the council config from the page's settings
+def build_config(king_model, peasant_models, copies=1):
+    return CouncilConfig(
+        king_model=king_model,
+        peasant_models=peasant_models,
+        openai_api_key=openai_api_key,
+        groq_api_key=groq_api_key,
+        # Copies are meant to be separate samples, so a copy never reuses a cached answer either
+        use_cache=use_cache and copies == 1,
+        stream_peasants=stream_peasants,
+        stream_king=stream_king,
+        quorum=int(quorum),
+        deadline=deadline,
+        show_late=show_late,
+        hedge=hedge,
+        incremental_king=incremental_king,
+        compact_king_prompt=compact_king_prompt,
+        summary_model="" if summary_model == "Truncate instead" else summary_model,
+        output_budgets={**output_budgets, "peasant": int(peasant_max_tokens), "king": int(king_max_tokens)},
+        compact_answers=compact_answers,
+        route_models=route_models,
+        latency_target=latency_target,
+        cost_target=cost_target,
+        fallback_king_model="" if fallback_king_model == "None" else fallback_king_model,
+        failover_peasants=failover_peasants,
+        group_size=int(group_size),
+        sub_king_model=sub_king_model,
+        # Copies are meant to be separate samples, so they must not share one call
+        share_duplicate_calls=copies == 1,
+    )
 
-    return answers, king_answer
+# Function to draw a stored run again, as it looked when it finished
+def show_run(run):
+    result = run["result"]
+    st.caption(f"Run {run['id']} of {time.strftime('%b %d %H:%M', time.localtime(run['created']))}, {run['king_model']} ruled" + (f" on the answers of run {run['parent']}" if run["parent"] else ""))
+    st.write(f"**Problem:** {run['inputs']['problem']}")
+    st.subheader("Peasant Outputs")
+    for name, advice in result.answers.items():
+        st.write(f"**{name}**")
+        st.text_area("", advice, height=150, key=name, help=f"Advice from {name}")
+    st.subheader("King's Verdict")
+    st.markdown(result.verdict)
+    for name, answer in result.late.items():
+        if answer is not None:
+            st.write(f"**{name}** (arrived after the verdict)")
+            st.text_area("", answer, height=150, key=name + "_late", help=f"Late advice from {name}")
+    show_timings(result)
 
 # Process the solution
 #st.subheader("Solve the Problem")
-if st.button("Consult the King"):
+consult = st.button("Consult the King")
+if consult:
     if not problem_statement:
         st.warning("Please enter a problem statement.")
     elif not (openai_api_key and groq_api_key):
@@ -106,14 +236,53 @@ if st.button("Consult the King"):
         st.error("Please select at least one Peasant Model.")
     else:
         #st.info("The King has summoned the Peasants")
-        peasant_outputs, final_solution = the_king(king_model, peasant_models, problem_statement)
+        peasant_models = [model for model in peasant_models for _ in range(int(copies))]
+        config = build_config(king_model, peasant_models, int(copies))
+        st.write("The KING has summoned the pesants")
+        for i, model in enumerate(peasant_models):
+            st.write(f"Peasant {i+1} is {model}...")
+        result = the_king(config, problem_statement, show_progress(peasant_models))
+        show_timings(result)
+        st.session_state["run_id"] = run_store.save("king", config, {"problem": problem_statement}, result, owner=owner)
+
+# The session's last run, or one opened from the history, survives reruns and can be replayed
+# into another King, who rules on the stored answers without any peasant being called again
+run = run_store.load(st.session_state["run_id"], owner) if not consult and st.session_state.get("run_id") else None
+if run is not None:
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        replay_model = st.selectbox("Let another King rule on these answers", gpt_models + groq_models, key="replay_king")
+    with col2:
+        replay = st.button("Replay")
+    if replay and not (openai_api_key and groq_api_key):
+        st.error("Please enter valid OpenAI and Groq API keys.")
+    elif replay:
+        config = build_config(replay_model, run["config"]["peasant_models"])
+        # Stored answers are drawn the way a live run draws them, then the King streams below them
+        on_event = show_progress([])
+        on_event("peasants_done", {"answers": run["result"].answers})
+        result = replay_king(config, run["inputs"]["problem"], run["result"].answers, on_event)
+        show_timings(result)
+        st.session_state["run_id"] = run_store.save("king", config, run["inputs"], result, parent=run["id"], owner=owner)
+    else:
+        show_run(run)
 
-        # Display each Peasant's output
-        st.subheader("Peasant Outputs")
-        for name, advice in peasant_outputs.items():
-            st.write(f"**{name}**")
-            st.text_area("", advice, height=150, key=name, help=f"Advice from {name}")
+# Cache counters, drawn last so they include this run
+cache_stats = completion_cache.stats()
+st.sidebar.caption(f"Cache: {cache_stats['hits']} hits ({cache_stats['disk_hits']} from disk), {cache_stats['misses']} misses, {cache_stats['entries']} answers in memory")
+# Recent latency, error rate and throughput of every model called so far
+routing_stats = {model: model_stats.summary(model, min_samples=1) for model in sorted(model_stats.models())}
+if routing_stats:
+    with st.sidebar.expander("Model latency"):
+        st.dataframe([{"model": model, **summary} for model, summary in routing_stats.items()], hide_index=True)
+open_circuits = circuit_breaker.open_circuits()
+if open_circuits:
+    st.sidebar.caption("Failing fast: " + ", ".join(f"{name} (next try in {seconds:.0f}s)" for name, seconds in open_circuits.items()))
+coalesced = inflight_calls.joined + inflight_streams.joined
+if coalesced:
+    st.sidebar.caption(f"Coalescing: {coalesced} calls joined an identical one already in flight")
+if hedge_stats["calls"]:
+    st.sidebar.caption(f"Hedging: {hedge_stats['hedged']} of {hedge_stats['calls']} peasant calls hedged ({hedge_stats['hedged'] / hedge_stats['calls']:.0%}), {hedge_stats['hedge_won']} won by the duplicate")
 
-        # Display King's Verdict
-        st.subheader("King's Verdict")
-        st.write(final_solution)
+# The page is drawn, so the provider SDKs can load in the background before the first call needs them
+warm_up()
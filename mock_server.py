@@ -0,0 +1,165 @@
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency profile per model: median time to first byte (s), its lognormal spread, and generation speed
+profiles = {
+    "gpt-4-turbo": {"ttfb": 0.8, "sigma": 0.5, "tokens_per_second": 35},
+    "gpt-4-0125-preview": {"ttfb": 0.9, "sigma": 0.6, "tokens_per_second": 30},
+    "gpt-3.5-turbo-0125": {"ttfb": 0.4, "sigma": 0.4, "tokens_per_second": 90},
+    "gpt-3.5-turbo-instruct": {"ttfb": 0.3, "sigma": 0.4, "tokens_per_second": 100},
+    "llama3-8b-8192": {"ttfb": 0.2, "sigma": 0.5, "tokens_per_second": 800},
+    "gemma-7b-it": {"ttfb": 0.2, "sigma": 0.5, "tokens_per_second": 700},
+    "llama3-70b-8192": {"ttfb": 0.3, "sigma": 0.6, "tokens_per_second": 300},
+    "mixtral-8x7b-32768": {"ttfb": 0.25, "sigma": 0.5, "tokens_per_second": 500},
+}
+default_profile = {"ttfb": 0.5, "sigma": 0.5, "tokens_per_second": 100}
+
+# time_scale shrinks every delay, error_rate is the share of attempts answered with a 500 or a 429
+mock_settings = {"time_scale": 1.0, "error_rate": 0.0, "output_tokens": 200, "seed": 0}
+
+_words = "the king asks peasants advice water earth tribe problem solve code answer plan risk cost time data model test build ship review".split()
+
+
+# Speaks the chat completions protocol of OpenAI (/v1/chat/completions) and Groq (/openai/v1/chat/completions)
+# Every attempt is seeded from the seed, model, prompt and attempt number, so runs are repeatable
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        model = request["model"]
+        prompt = "".join(message["content"] for message in request["messages"])
+        rng = random.Random(self.server.seed_for(model, prompt))
+        profile = profiles.get(model, default_profile)
+        scale = mock_settings["time_scale"]
+
+        if rng.random() < mock_settings["error_rate"]:
+            time.sleep(0.05 * scale)
+            if rng.random() < 0.5:
+                self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit"}}, {"retry-after": f"{0.5 * scale:.3f}"})
+            else:
+                self._send_json(500, {"error": {"message": "Injected server error", "type": "server_error"}})
+            return
+
+        tokens = min(request.get("max_tokens") or mock_settings["output_tokens"], mock_settings["output_tokens"])
+        finish_reason = "length" if tokens < mock_settings["output_tokens"] else "stop"
+        words = [rng.choice(_words) for _ in range(tokens)]
+        ttfb = rng.lognormvariate(math.log(profile["ttfb"]), profile["sigma"]) * scale
+        per_token = scale / profile["tokens_per_second"]
+        usage = {"prompt_tokens": len(prompt) // 4 + 1, "completion_tokens": tokens, "total_tokens": len(prompt) // 4 + 1 + tokens}
+        time.sleep(ttfb)
+
+        if not request.get("stream"):
+            time.sleep(per_token * tokens)
+            self._send_json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": f"{model}: " + " ".join(words)}, "finish_reason": finish_reason}],
+                "usage": usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = [f"{model}:"] + words
+        for i in range(0, len(pieces), 4):
+            time.sleep(per_token * len(pieces[i:i + 4]))
+            self._send_chunk(model, {"content": " ".join(pieces[i:i + 4]) + " "}, None)
+        self._send_chunk(model, {}, finish_reason, usage)
+        self._write_chunked(b"data: [DONE]\n\n")
+        self._write_chunked(b"")
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunk(self, model, delta, finish_reason, usage=None):
+        chunk = {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        if usage is not None:
+            chunk["usage"] = usage
+        self._write_chunked(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+
+    def _write_chunked(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, MockHandler)
+        self.attempts = {}
+        self._lock = threading.Lock()
+
+    # Retries of the same request get the next seed, so an injected error is not repeated forever
+    def seed_for(self, model, prompt):
+        key = zlib.crc32(f"{mock_settings['seed']}|{model}|{prompt}".encode("utf-8"))
+        with self._lock:
+            attempt = self.attempts[key] = self.attempts.get(key, 0) + 1
+        return key * 1000 + attempt
+
+    # Starts every request over at its first seed, so a run does not depend on the runs before it
+    def reset(self):
+        with self._lock:
+            self.attempts.clear()
+
+    # Clients hang up on purpose, such as a hedged call cutting off the loser, so that is not an error
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+
+# Function to start the mock server on a background thread, returns the server and its base url
+def start_server(host="127.0.0.1", port=0):
+    server = MockServer((host, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+# Function to get the base urls that point both providers at a mock server
+def base_urls(url):
+    return {"openai": f"{url}/v1", "groq": url}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI and Groq chat completions APIs.")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Multiply every delay by this")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of attempts that fail with a 500 or 429")
+    parser.add_argument("--output-tokens", type=int, default=200, help="Tokens in every answer")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    mock_settings.update(time_scale=args.time_scale, error_rate=args.error_rate, output_tokens=args.output_tokens, seed=args.seed)
+    server = MockServer(("127.0.0.1", args.port))
+    print(f"Mock provider on http://127.0.0.1:{args.port}")
+    print(f"  OPENAI_BASE_URL=http://127.0.0.1:{args.port}/v1  GROQ_BASE_URL=http://127.0.0.1:{args.port}")
+    server.serve_forever()
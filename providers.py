@@ -0,0 +1,230 @@
+import hashlib
+import importlib
+import threading
+import time
+from collections import OrderedDict
+
+from cache import completion_cache
+from ratelimit import call_with_retries, estimate_tokens, is_retryable
+from singleflight import SingleFlight, StreamFlight
+from stats import model_stats
+from telemetry import annotate, mark
+
+# Connection pool and timeout settings shared by every provider client
+# base_urls points a provider at another endpoint such as mock_server.py, otherwise the SDK default
+# (or its OPENAI_BASE_URL / GROQ_BASE_URL environment variable) is used
+# max_clients caps the (provider, api key) clients kept, the least recently used one is closed close_grace
+# seconds after it is dropped, so a call still holding it can finish
+client_settings = {"pool_size": 20, "timeout": 60.0, "base_urls": {}, "max_clients": 32, "close_grace": 300.0}
+
+# Clients live at module level so they survive Streamlit reruns and are shared by all sessions
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+# Upstream calls in flight, shared by every session of the process and keyed like the cache,
+# so identical requests made at the same time from different sessions cost one call
+inflight_calls = SingleFlight()
+inflight_streams = StreamFlight()
+
+# The provider SDKs take a good part of a second to import, so they are only imported when the first
+# client is built, or by warm_up on a background thread once the page is drawn
+sdk_modules = ("httpx", "openai", "groq")
+_warm_up_started = threading.Event()
+
+# Function to import the provider SDKs, later imports of them are free
+def import_sdks():
+    return [importlib.import_module(name) for name in sdk_modules]
+
+# Function to import the provider SDKs on a background thread, once per process
+def warm_up():
+    if not _warm_up_started.is_set():
+        _warm_up_started.set()
+        threading.Thread(target=import_sdks, name="sdk-warm-up", daemon=True).start()
+
+# Function to time the first byte of a successful response, httpx calls it on the requesting thread
+def _on_response(response):
+    if response.status_code < 400:
+        mark("ttfb")
+
+# Function to build a client with its own keep-alive connection pool
+def _build_client(provider, api_key):
+    httpx, openai, groq = import_sdks()
+    pool_size = client_settings["pool_size"]
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        timeout=client_settings["timeout"],
+        event_hooks={"response": [_on_response]},
+    )
+    # Retries are done by ratelimit.call_with_retries so they respect the shared limits
+    base_url = client_settings["base_urls"].get(provider)
+    if provider == "openai":
+        return openai.OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+    if provider == "groq":
+        return groq.Groq(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+    raise ValueError(f"Unknown provider: {provider}")
+
+# Function to close a client dropped from _clients once calls that may still hold it had time to finish
+def _close_later(client):
+    timer = threading.Timer(client_settings["close_grace"], client.close)
+    timer.daemon = True
+    timer.start()
+
+# Function to get the client for a (provider, api key), created once per process while it stays among the
+# max_clients most recently used, so keys typed by many visitors do not pile up clients and sockets
+def get_client(provider, api_key):
+    key = (provider, api_key)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            _clients.move_to_end(key)
+            return client
+        client = _clients[key] = _build_client(provider, api_key)
+        while len(_clients) > client_settings["max_clients"]:
+            _close_later(_clients.popitem(last=False)[1])
+    return client
+
+# Function to change pool size / timeout / base urls, existing clients are closed and rebuilt on next use
+def configure_clients(pool_size=None, timeout=None, base_urls=None):
+    with _clients_lock:
+        if pool_size is not None:
+            client_settings["pool_size"] = pool_size
+        if timeout is not None:
+            client_settings["timeout"] = timeout
+        if base_urls is not None:
+            client_settings["base_urls"] = base_urls
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+# Function to send a chat completion through the rate limiter and retry layer
+# stop lists sequences the model stops writing at, the provider's limit is four
+def chat_completion(provider, api_key, model, system_message, messages, max_tokens=None, stream=False, stop=None):
+    client = get_client(provider, api_key)
+    request = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": messages}
+        ],
+        "temperature": 0.3,
+    }
+    if max_tokens is not None:
+        request["max_tokens"] = max_tokens
+    if stop:
+        request["stop"] = list(stop)
+    if stream:
+        request["stream"] = True
+        # OpenAI only reports token usage of a stream when asked, Groq always does in x_groq
+        if provider == "openai":
+            request["stream_options"] = {"include_usage": True}
+    tokens = estimate_tokens(messages, system_message, max_tokens)
+    annotate(provider=provider, model=model, cache_hit=False)
+    try:
+        return call_with_retries(lambda: client.chat.completions.create(**request), provider, model, tokens)
+    except Exception as e:
+        # Only a failure of the backend counts against the model: a bad key or prompt is the caller's,
+        # and a circuit breaker refusal never reached it
+        if is_retryable(e):
+            model_stats.record_failure(model)
+        raise
+
+# Function to put the token usage a provider reported on the current span, returns the completion tokens
+def record_usage(usage):
+    if usage is None:
+        return None
+    annotate(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+    return usage.completion_tokens
+
+# Function to make an uncached call and cache its answer
+# An answer cut off by max_tokens is marked truncated on its span
+def complete(provider, key, api_key, model, system_message, messages, max_tokens=None, stop=None):
+    annotate(coalesced=False)
+    start = time.perf_counter()
+    response = chat_completion(provider, api_key, model, system_message, messages, max_tokens=max_tokens, stop=stop)
+    model_stats.record(model, time.perf_counter() - start, record_usage(response.usage))
+    if response.choices[0].finish_reason == "length":
+        annotate(truncated=True)
+    answer = response.choices[0].message.content.strip()
+    completion_cache.put(key, answer)
+    return answer
+
+# Function to stream an uncached call as text chunks and cache the whole answer once it is done
+def stream_completion(provider, key, api_key, model, system_message, messages, max_tokens=None, stop=None):
+    annotate(coalesced=False)
+    start = time.perf_counter()
+    stream = chat_completion(provider, api_key, model, system_message, messages, max_tokens=max_tokens, stream=True, stop=stop)
+    text = ""
+    tokens = None
+    try:
+        for chunk in stream:
+            tokens = record_usage(getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None)) or tokens
+            if chunk.choices and chunk.choices[0].finish_reason == "length":
+                annotate(truncated=True)
+            if chunk.choices and chunk.choices[0].delta.content:
+                mark("ttft")
+                text += chunk.choices[0].delta.content
+                yield chunk.choices[0].delta.content
+    finally:
+        stream.close()
+    model_stats.record(model, time.perf_counter() - start, tokens)
+    completion_cache.put(key, text.strip())
+
+# Function to key a call in flight: its cache key and a hash of the API key, so only callers with the same key
+# share one call, and none is billed to someone else's key or handed their auth or quota errors
+def flight_key(key, api_key):
+    return key, hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+# Function to make a call, sharing it with identical calls already in flight from any session when coalesce is on
+def shared_call(coalesce, provider, key, api_key, model, system_message, messages, max_tokens=None, stop=None):
+    if not coalesce:
+        return complete(provider, key, api_key, model, system_message, messages, max_tokens, stop)
+    # complete() clears the mark on the one caller that really makes the call
+    annotate(coalesced=True)
+    return inflight_calls.run(flight_key(key, api_key), complete, provider, key, api_key, model, system_message, messages, max_tokens, stop)
+
+# Function to stream a call, following an identical stream already in flight from any session when coalesce is on
+def shared_stream(coalesce, provider, key, api_key, model, system_message, messages, max_tokens=None, stop=None):
+    if not coalesce:
+        return stream_completion(provider, key, api_key, model, system_message, messages, max_tokens, stop)
+    annotate(coalesced=True)
+    return inflight_streams.stream(flight_key(key, api_key), stream_completion, provider, key, api_key, model, system_message, messages, max_tokens, stop)
+
+# Function to call OpenAI API, max_tokens None leaves the answer's length to the model
+def openai_call(messages, model, system_message, api_key, use_cache=True, coalesce=True, max_tokens=None, stop=None):
+    key = completion_cache.key("openai", model, system_message, messages, 0.3, max_tokens, stop)
+    cached = completion_cache.get(key) if use_cache else None
+    if cached is not None:
+        annotate(cache_hit=True)
+        return cached
+    return shared_call(coalesce, "openai", key, api_key, model, system_message, messages, max_tokens, stop)
+
+# Function to call Groq API, answers are cut at 1024 tokens unless max_tokens says otherwise
+def groq_call(messages, model, api_key, use_cache=True, coalesce=True, system_message="You are a coder and problem solver expert", max_tokens=None, stop=None):
+    max_tokens = max_tokens or 1024
+    key = completion_cache.key("groq", model, system_message, messages, 0.3, max_tokens, stop)
+    cached = completion_cache.get(key) if use_cache else None
+    if cached is not None:
+        annotate(cache_hit=True)
+        return cached
+    return shared_call(coalesce, "groq", key, api_key, model, system_message, messages, max_tokens, stop)
+
+# Function to stream the OpenAI reply as text chunks
+def openai_stream(messages, model, system_message, api_key, use_cache=True, coalesce=True, max_tokens=None, stop=None):
+    key = completion_cache.key("openai", model, system_message, messages, 0.3, max_tokens, stop)
+    cached = completion_cache.get(key) if use_cache else None
+    if cached is not None:
+        annotate(cache_hit=True)
+        yield cached
+        return
+    yield from shared_stream(coalesce, "openai", key, api_key, model, system_message, messages, max_tokens, stop)
+
+# Function to stream the Groq reply as text chunks
+def groq_stream(messages, model, api_key, use_cache=True, coalesce=True, system_message="You are a coder and problem solver expert", max_tokens=None, stop=None):
+    max_tokens = max_tokens or 1024
+    key = completion_cache.key("groq", model, system_message, messages, 0.3, max_tokens, stop)
+    cached = completion_cache.get(key) if use_cache else None
+    if cached is not None:
+        annotate(cache_hit=True)
+        yield cached
+        return
+    yield from shared_stream(coalesce, "groq", key, api_key, model, system_message, messages, max_tokens, stop)
@@ -0,0 +1,143 @@
+import email.utils
+import random
+import threading
+import time
+
+from breaker import circuit_breaker
+from telemetry import count
+
+# Requests and tokens per minute, per provider or per "provider/model" which wins when present
+rate_limits = {
+    "openai": {"rpm": 500, "tpm": 150000},
+    "groq": {"rpm": 30, "tpm": 15000},
+}
+
+# Retry settings for 429s, 5xx and dropped connections
+retry_settings = {"max_attempts": 5, "base_delay": 0.5, "max_delay": 30.0}
+
+
+# Refills continuously at per_minute / 60 per second up to a full minute's worth
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    # Blocks until amount is available, requests bigger than the bucket only wait for a full one
+    def take(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                delay = max(self.blocked_until - now, (amount - self.tokens) / self.rate)
+            time.sleep(delay)
+
+    # Stop handing out tokens for a while, used when the provider says so with Retry-After
+    def pause(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+# One request bucket and one token bucket per provider or model, shared by the whole process
+class RateLimiter:
+    def __init__(self, limits):
+        self.limits = limits
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _buckets_for(self, provider, model):
+        name = f"{provider}/{model}" if f"{provider}/{model}" in self.limits else provider
+        with self._lock:
+            if name not in self._buckets:
+                limit = self.limits[name]
+                self._buckets[name] = (TokenBucket(limit["rpm"]), TokenBucket(limit["tpm"]))
+            return self._buckets[name]
+
+    def acquire(self, provider, model, tokens):
+        requests, token_budget = self._buckets_for(provider, model)
+        requests.take(1)
+        token_budget.take(tokens)
+
+    def pause(self, provider, model, seconds):
+        for bucket in self._buckets_for(provider, model):
+            bucket.pause(seconds)
+
+
+rate_limiter = RateLimiter(rate_limits)
+
+# Function to guess the tokens a request will use, about four characters per token
+def estimate_tokens(prompt, system_message, max_tokens):
+    return (len(prompt) + len(system_message)) // 4 + (max_tokens or 512)
+
+# Function to read Retry-After (seconds or an HTTP date) from a provider error
+def retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    # A header that is neither seconds nor a date is ignored, so the usual backoff applies
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, parsed.timestamp() - time.time())
+
+# Function to tell whether an error is worth retrying
+def is_retryable(error):
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    # Connection errors and timeouts of both SDKs carry no status code
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+# Function to run a provider request under the rate limiter, retrying with jittered exponential backoff
+# Every attempt goes through the circuit breaker, so an unhealthy provider or model fails fast with CircuitOpenError
+def call_with_retries(request, provider, model, tokens):
+    attempts = retry_settings["max_attempts"]
+    for attempt in range(attempts):
+        circuit_breaker.check(provider, model)
+        waited = time.perf_counter()
+        rate_limiter.acquire(provider, model, tokens)
+        count(queue_wait=time.perf_counter() - waited)
+        try:
+            response = request()
+        except Exception as e:
+            # Only failures of the backend count against it: a rejected request means it is up,
+            # and a 429 that it is busy, which the rate limiter deals with
+            status = getattr(e, "status_code", None)
+            if status == 429:
+                pass
+            elif is_retryable(e):
+                circuit_breaker.record_failure(provider, model)
+            elif status is not None:
+                circuit_breaker.record_success(provider, model)
+            if attempt == attempts - 1 or not is_retryable(e):
+                raise
+            count(retries=1)
+            delay = retry_after(e)
+            if delay is not None:
+                rate_limiter.pause(provider, model, delay)
+            else:
+                delay = random.uniform(0, min(retry_settings["max_delay"], retry_settings["base_delay"] * 2 ** attempt))
+            time.sleep(delay)
+            continue
+        circuit_breaker.record_success(provider, model)
+        return response
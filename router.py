@@ -0,0 +1,58 @@
+from stats import model_stats
+
+# Models that can stand in for each other, in order of preference
+equivalent_models = {
+    "gpt-4-turbo": ["gpt-4-0125-preview", "llama3-70b-8192"],
+    "gpt-4-0125-preview": ["gpt-4-turbo", "llama3-70b-8192"],
+    "gpt-3.5-turbo-0125": ["llama3-70b-8192", "mixtral-8x7b-32768"],
+    "gpt-3.5-turbo-instruct": ["gpt-3.5-turbo-0125", "llama3-8b-8192"],
+    "llama3-70b-8192": ["mixtral-8x7b-32768", "gpt-3.5-turbo-0125"],
+    "mixtral-8x7b-32768": ["llama3-70b-8192", "gemma-7b-it"],
+    "llama3-8b-8192": ["gemma-7b-it", "mixtral-8x7b-32768"],
+    "gemma-7b-it": ["llama3-8b-8192", "mixtral-8x7b-32768"],
+}
+
+# Dollars per million output tokens, what a cost target is compared against
+model_prices = {
+    "gpt-4-turbo": 30.0,
+    "gpt-4-0125-preview": 30.0,
+    "gpt-3.5-turbo-0125": 1.5,
+    "gpt-3.5-turbo-instruct": 2.0,
+    "llama3-8b-8192": 0.08,
+    "gemma-7b-it": 0.1,
+    "llama3-70b-8192": 0.79,
+    "mixtral-8x7b-32768": 0.24,
+}
+
+
+# Function to tell why a model misses the targets, None when it meets them
+# A model without enough recent calls is given the benefit of the doubt
+def missed_target(model, latency_target=0, max_error_rate=0, cost_target=0):
+    if cost_target and model_prices.get(model, 0) > cost_target:
+        return f"costs ${model_prices[model]:g} per million tokens"
+    summary = model_stats.summary(model)
+    if latency_target and summary["p95"] is not None and summary["p95"] > latency_target:
+        return f"p95 latency is {summary['p95']:.1f}s"
+    if max_error_rate and summary["error_rate"] is not None and summary["error_rate"] > max_error_rate:
+        return f"error rate is {summary['error_rate']:.0%}"
+    return None
+
+# Function to pick the model to ask in place of model, returns it and the reason model was swapped or None
+# Equivalents that meet the targets are tried fastest first; when none does the fastest known one is used
+# allowed filters out equivalents that cannot be called, such as those of a provider without a key
+def pick_model(model, latency_target=0, max_error_rate=0, cost_target=0, allowed=None):
+    reason = missed_target(model, latency_target, max_error_rate, cost_target)
+    if reason is None:
+        return model, None
+    candidates = [candidate for candidate in equivalent_models.get(model, []) if allowed is None or allowed(candidate)]
+
+    def speed(candidate):
+        p95 = model_stats.summary(candidate)["p95"]
+        return (p95 is None, p95 or 0)
+
+    meeting = [candidate for candidate in candidates if missed_target(candidate, latency_target, max_error_rate, cost_target) is None]
+    if meeting:
+        return min(meeting, key=speed), reason
+    known = [candidate for candidate in [model] + candidates if model_stats.summary(candidate)["p95"] is not None]
+    best = min(known, key=speed) if known else model
+    return best, reason if best != model else None
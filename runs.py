@@ -0,0 +1,80 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import asdict, fields
+
+from council import CouncilResult
+
+# Settings that never reach the disk
+secret_settings = ("openai_api_key", "groq_api_key", "trace")
+
+# Runs older than max_age seconds, and all but the newest max_runs, are deleted as new runs are saved (0 keeps them)
+retention = {"max_age": 30 * 24 * 3600, "max_runs": 5000}
+
+
+# Every finished council run kept in SQLite: its config, inputs and result, so it can be drawn again or replayed
+# kind is "king" for the_king runs and "tribes" for tribe councils, inputs holds their problem or tribes
+# owner is whoever may list and open a run, such as a page session, so users of a shared server never see each other's runs
+class RunStore:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS runs (id TEXT PRIMARY KEY, created REAL, kind TEXT, title TEXT, king_model TEXT, parent TEXT, config TEXT, inputs TEXT, result TEXT, owner TEXT)")
+        # Stores written before runs had owners get the column, their runs belong to no one
+        if "owner" not in [column[1] for column in self._db.execute("PRAGMA table_info(runs)")]:
+            self._db.execute("ALTER TABLE runs ADD COLUMN owner TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_kind_created ON runs (kind, created)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_owner_kind_created ON runs (owner, kind, created)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_created ON runs (created)")
+        self._db.commit()
+
+    # Saves a run and returns its id, parent is the run whose answers a replayed run reused
+    def save(self, kind, config, inputs, result, parent=None, owner=None):
+        run_id = uuid.uuid4().hex[:12]
+        settings = {f.name: getattr(config, f.name) for f in fields(config) if f.name not in secret_settings}
+        title = inputs.get("problem") or " / ".join(tribe["problem"] for tribe in inputs.get("tribes", []))
+        row = (run_id, time.time(), kind, title[:200], config.king_model, parent, json.dumps(settings), json.dumps(inputs), json.dumps(asdict(result), default=str), owner)
+        with self._lock:
+            self._db.execute("INSERT INTO runs (id, created, kind, title, king_model, parent, config, inputs, result, owner) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            self.prune()
+            self._db.commit()
+        return run_id
+
+    # Deletes the runs retention no longer keeps, called with the lock held
+    def prune(self):
+        if retention["max_age"]:
+            self._db.execute("DELETE FROM runs WHERE created < ?", (time.time() - retention["max_age"],))
+        if retention["max_runs"]:
+            self._db.execute("DELETE FROM runs WHERE id IN (SELECT id FROM runs ORDER BY created DESC LIMIT -1 OFFSET ?)", (retention["max_runs"],))
+
+    # A run by id as a dict with its result as a CouncilResult, None when there is no such run of owner
+    def load(self, run_id, owner=None):
+        with self._lock:
+            row = self._db.execute("SELECT id, created, kind, title, king_model, parent, config, inputs, result FROM runs WHERE id = ? AND owner IS ?", (run_id, owner)).fetchone()
+        if row is None:
+            return None
+        run_id, created, kind, title, king_model, parent, config, inputs, result = row
+        return {
+            "id": run_id,
+            "created": created,
+            "kind": kind,
+            "title": title,
+            "king_model": king_model,
+            "parent": parent,
+            "config": json.loads(config),
+            "inputs": json.loads(inputs),
+            "result": CouncilResult(**json.loads(result)),
+        }
+
+    # The latest runs of a kind and owner, newest first, without their results
+    def recent(self, kind, owner=None, limit=50):
+        with self._lock:
+            rows = self._db.execute("SELECT id, created, title, king_model, parent FROM runs WHERE kind = ? AND owner IS ? ORDER BY created DESC LIMIT ?", (kind, owner, limit)).fetchall()
+        return [{"id": run_id, "created": created, "title": title, "king_model": king_model, "parent": parent} for run_id, created, title, king_model, parent in rows]
+
+
+# Process-wide store shared by every session, KING_RUNS_PATH moves it
+run_store = RunStore(os.environ.get("KING_RUNS_PATH", "king_runs.db"))
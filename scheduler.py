@@ -0,0 +1,79 @@
+import queue
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+
+
+# Runs tasks on worker threads while delivering their events on the thread that owns the pool
+# Every task is called with its arguments plus an emit function as the last argument
+class Workers:
+    def __init__(self, on_event, max_workers):
+        self.on_event = on_event or (lambda event, data: None)
+        self.events = queue.Queue()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = {}
+
+    def emit(self, event, data):
+        self.events.put((event, data))
+
+    def submit(self, key, task, *args):
+        self.futures[self.pool.submit(task, *args, self.emit)] = key
+
+    def drain(self):
+        while not self.events.empty():
+            self.on_event(*self.events.get())
+
+    # Waits up to timeout for a task to finish, delivers the events so far and returns (key, future) of finished tasks
+    def poll(self, timeout=0.1):
+        done = set()
+        if self.futures:
+            done, _ = wait(self.futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        self.drain()
+        return [(self.futures.pop(future), future) for future in done]
+
+    # Yields (key, future) as tasks finish, tasks submitted meanwhile are waited for too
+    def as_completed(self):
+        while self.futures:
+            yield from self.poll()
+        self.drain()
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+# A task of a dependency graph, called with a dict of the results of its deps and an emit function
+# once every node it depends on is done
+@dataclass
+class Node:
+    key: object
+    task: object
+    deps: list = field(default_factory=list)
+
+
+# Function to run a dependency graph, every node starts on its own thread as soon as its deps are done
+# Limits on model calls are up to the tasks; on_done(key, result) runs on the calling thread as each node
+# finishes, before anything that depends on it starts. Returns the result and seconds of every node
+# The first node to fail stops the run with its error
+def run_graph(nodes, on_event=None, on_done=None):
+    pending = {node.key: node for node in nodes}
+    results = {}
+    seconds = {}
+    started = {}
+    workers = Workers(on_event, max_workers=max(1, len(nodes)))
+    try:
+        while pending or workers.futures:
+            for key, node in list(pending.items()):
+                if all(dep in results for dep in node.deps):
+                    del pending[key]
+                    started[key] = time.perf_counter()
+                    workers.submit(key, node.task, {dep: results[dep] for dep in node.deps})
+            if not workers.futures:
+                raise ValueError(f"Nodes wait on missing or circular dependencies: {list(pending)}")
+            for key, future in workers.poll():
+                results[key] = future.result()
+                seconds[key] = time.perf_counter() - started[key]
+                if on_done is not None:
+                    on_done(key, results[key])
+    finally:
+        workers.close()
+    return results, seconds
@@ -0,0 +1,303 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, fields
+
+from dotenv import load_dotenv
+
+from council import CouncilConfig, Tribe, the_king, tribes_council
+from providers import configure_clients, warm_up
+from runs import run_store
+
+# Largest JSON job accepted, in bytes
+max_body = 1 << 20
+
+# Seconds between keep-alive comments on a quiet event stream, so proxies do not drop it
+keep_alive = 15.0
+
+http_reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large"}
+
+# Settings a job may send, everything in CouncilConfig but the trace
+job_settings = {f.name for f in fields(CouncilConfig)} - {"trace"}
+
+# What the values of a job's dict settings must be, as JSON gives them
+setting_values = {"max_parallel": int, "output_budgets": int, "stop_sequences": list, "hedge_models": str}
+
+# How a type is named to clients, in JSON terms
+json_types = {bool: "a boolean", int: "an integer", float: "a number", str: "a string", list: "a list of strings", dict: "an object"}
+
+
+# Raised from a job's event handler once its client hung up, so the council stops at its next event
+# It is a BaseException so the council's own failover and retry handlers let it through
+class ClientGone(BaseException):
+    pass
+
+
+# A bad request, answered with its status and message
+class BadRequest(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# Function to tell whether a JSON value fits a dataclass field's type, model lists must hold strings
+def fits(expected, value, values=None):
+    if expected is bool:
+        return isinstance(value, bool)
+    if expected is int:
+        return isinstance(value, int) and not isinstance(value, bool)
+    if expected is float:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if expected is list:
+        return isinstance(value, list) and all(isinstance(item, str) for item in value)
+    if expected is dict:
+        return isinstance(value, dict) and (values is None or all(fits(values, item) for item in value.values()))
+    return isinstance(value, expected)
+
+# Function to check the types of settings meant for a dataclass, so a bad job is refused before its stream starts
+def check_types(cls, settings, what):
+    types = {f.name: f.type for f in fields(cls)}
+    for name, value in settings.items():
+        if name in types and not fits(types[name], value, setting_values.get(name)):
+            expected = json_types[types[name]] + (f" whose values are {json_types[setting_values[name]]}" if name in setting_values else "")
+            raise BadRequest(400, f"{what}{name} must be {expected}, got {json.dumps(value)[:80]}")
+
+# Function to build the council config of a job, API keys not in the job come from the environment
+def job_config(job):
+    unknown = set(job) - job_settings - {"problem", "tribes"}
+    if unknown:
+        raise BadRequest(400, f"Unknown settings: {', '.join(sorted(unknown))}")
+    settings = {name: value for name, value in job.items() if name in job_settings}
+    check_types(CouncilConfig, settings, "")
+    settings.setdefault("openai_api_key", os.environ.get("OPENAI_API_KEY", ""))
+    settings.setdefault("groq_api_key", os.environ.get("GROQ_API_KEY", ""))
+    # Progress is what the service streams, so peasants and King stream unless the job says otherwise
+    settings.setdefault("stream_peasants", True)
+    settings.setdefault("stream_king", True)
+    if "king_model" not in settings:
+        raise BadRequest(400, "king_model is required")
+    try:
+        return CouncilConfig(**settings)
+    except TypeError as e:
+        raise BadRequest(400, str(e))
+
+# Function to turn a job into the council call that runs it: (kind, inputs, run) where run takes on_event
+def parse_job(path, job):
+    config = job_config(job)
+    if path == "/v1/king":
+        if not job.get("problem") or not isinstance(job["problem"], str):
+            raise BadRequest(400, "problem is required and must be a string")
+        if not config.peasant_models:
+            raise BadRequest(400, "peasant_models is required")
+        return "king", config, {"problem": job["problem"]}, lambda on_event: the_king(config, job["problem"], on_event)
+    if path == "/v1/tribes":
+        if not isinstance(job.get("tribes") or [], list):
+            raise BadRequest(400, "tribes must be a list")
+        try:
+            for tribe in job.get("tribes") or []:
+                check_types(Tribe, tribe if isinstance(tribe, dict) else {}, "tribe ")
+            tribes = [Tribe(**tribe) for tribe in job.get("tribes") or []]
+        except TypeError as e:
+            raise BadRequest(400, f"Bad tribe: {e}")
+        if not tribes or not all(tribe.name and tribe.models and tribe.problem for tribe in tribes):
+            raise BadRequest(400, "tribes must each have a name, models and a problem")
+        return "tribes", config, {"tribes": [asdict(tribe) for tribe in tribes]}, lambda on_event: tribes_council(config, tribes, on_event)
+    raise BadRequest(404, f"No endpoint {path}")
+
+# Function to turn a chunk event carrying the text so far into one carrying only the new text
+# sent holds the text already sent per stream; a stream that starts over is sent whole with reset
+def as_delta(sent, event, data):
+    key = (event, data.get("name", data.get("section")))
+    before = sent.get(key, "")
+    sent[key] = data["text"]
+    if data["text"].startswith(before):
+        return {**data, "text": data["text"][len(before):]}
+    return {**data, "reset": True}
+
+# Function to format one server-sent event
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n".encode("utf-8")
+
+
+# Runs council jobs for HTTP clients: the event loop serves every connection and streams progress,
+# while each council runs on a thread of the job pool, as in the Streamlit pages and batch.py
+# Provider calls stay on the council's own threads, so the loop never waits on a model
+class CouncilService:
+    def __init__(self, max_jobs):
+        self.jobs = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="council-job")
+        # Job threads are started up front: starting one takes the GIL from hundreds of busy ones,
+        # and submit would start it on the event loop
+        started = threading.Barrier(max_jobs + 1)
+        for _ in range(max_jobs):
+            self.jobs.submit(started.wait)
+        started.wait()
+        self.max_jobs = max_jobs
+        self.running = 0
+        self.queued = 0
+        self._lock = threading.Lock()
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                method, path, headers, body = await self.read_request(reader)
+                if path == "/health":
+                    await self.respond(writer, 200, {"ok": True, "running": self.running, "queued": self.queued, "max_jobs": self.max_jobs})
+                    return
+                if method != "POST":
+                    raise BadRequest(405, f"{method} is not allowed, POST a JSON job")
+                try:
+                    job = json.loads(body or b"{}")
+                except ValueError as e:
+                    raise BadRequest(400, f"Body is not JSON: {e}")
+                if not isinstance(job, dict):
+                    raise BadRequest(400, "Body must be a JSON object")
+                kind, config, inputs, run = parse_job(path, job)
+            except BadRequest as e:
+                await self.respond(writer, e.status, {"error": str(e)})
+                return
+            await self.stream(writer, kind, config, inputs, run)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        request_line = await reader.readline()
+        try:
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise BadRequest(400, "Malformed request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise BadRequest(400, "Content-Length is not a number")
+        if length < 0:
+            raise BadRequest(400, "Content-Length is negative")
+        if length > max_body:
+            raise BadRequest(413, f"Jobs are limited to {max_body} bytes")
+        body = await reader.readexactly(length) if length else b""
+        return method, path.split("?")[0], headers, body
+
+    async def respond(self, writer, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status} {http_reasons.get(status, '')}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+
+    # Streams a job's events to the client as they happen, then its result
+    async def stream(self, writer, kind, config, inputs, run):
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        gone = threading.Event()
+        sent = {}
+
+        def on_event(event, data):
+            if gone.is_set():
+                raise ClientGone()
+            if event in ("peasant_chunk", "king_chunk"):
+                data = as_delta(sent, event, data)
+            loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+        def job():
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                on_event("job_started", {"kind": kind})
+                result = run(on_event)
+                run_id = run_store.save(kind, config, inputs, result)
+                loop.call_soon_threadsafe(events.put_nowait, ("result", {"run_id": run_id, **asdict(result)}))
+            except ClientGone:
+                pass
+            except Exception as e:
+                loop.call_soon_threadsafe(events.put_nowait, ("error", {"error": f"{type(e).__name__}: {e}"}))
+            finally:
+                with self._lock:
+                    self.running -= 1
+                loop.call_soon_threadsafe(events.put_nowait, None)
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+        with self._lock:
+            self.queued += 1
+        self.jobs.submit(job)
+        try:
+            await writer.drain()
+            while True:
+                try:
+                    item = await asyncio.wait_for(events.get(), keep_alive)
+                except asyncio.TimeoutError:
+                    writer.write(b": keep-alive\n\n")
+                    await writer.drain()
+                    continue
+                # Whatever else arrived meanwhile goes out in the same write
+                items = [item]
+                while items[-1] is not None and not events.empty():
+                    items.append(events.get_nowait())
+                writer.write(b"".join(sse(*item) for item in items if item is not None))
+                await writer.drain()
+                if items[-1] is None:
+                    break
+        except ConnectionError:
+            gone.set()
+
+    def close(self):
+        self.jobs.shutdown(wait=False, cancel_futures=True)
+
+
+async def serve(host, port, max_jobs):
+    service = CouncilService(max_jobs)
+    server = await asyncio.start_server(service.handle, host, port, limit=max_body, backlog=1024)
+    warm_up()
+    print(f"Serving the council on http://{host}:{server.sockets[0].getsockname()[1]}", file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP service running the King and his Peasants, streaming their progress as server-sent events.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-jobs", type=int, default=256, help="Councils running at once, later jobs wait for a free slot")
+    parser.add_argument("--pool-size", type=int, help="Connections kept open per provider and API key, shared by every job (default: providers.client_settings)")
+    parser.add_argument("--mock", action="store_true", help="Answer from a local mock provider instead of OpenAI and Groq")
+    parser.add_argument("--time-scale", type=float, default=0.1, help="With --mock, multiply the mock's delays by this")
+    args = parser.parse_args(argv)
+    load_dotenv()
+
+    if args.pool_size:
+        configure_clients(pool_size=args.pool_size)
+    if args.mock:
+        from mock_server import base_urls, mock_settings, start_server
+        from ratelimit import rate_limits, retry_settings
+
+        mock_settings.update(time_scale=args.time_scale)
+        _, url = start_server()
+        configure_clients(base_urls=base_urls(url))
+        # The mock has no rate limits of its own, so only the retry layer is exercised
+        for limit in rate_limits.values():
+            limit.update(rpm=10 ** 6, tpm=10 ** 9)
+        retry_settings["base_delay"] *= args.time_scale
+        os.environ.setdefault("OPENAI_API_KEY", "mock")
+        os.environ.setdefault("GROQ_API_KEY", "mock")
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.max_jobs))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,38 @@
+import re
+import zlib
+
+# MinHash settings: word shingles of this size, this many hash functions
+shingle_size = 5
+num_hashes = 64
+_prime = (1 << 61) - 1
+_coefficients = [((i * 0x9E3779B1 + 1) % _prime, (i * 0x85EBCA77 + 7) % _prime) for i in range(num_hashes)]
+
+
+# Function to split a text into overlapping word shingles
+def shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < shingle_size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1)}
+
+# Function to compute the MinHash signature of a text
+def signature(text):
+    hashes = [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles(text)]
+    return [min((a * h + b) % _prime for h in hashes) for a, b in _coefficients]
+
+# Function to estimate the Jaccard similarity of two texts from their signatures
+def similarity(first, second):
+    return sum(1 for a, b in zip(first, second) if a == b) / num_hashes
+
+# Function to group near-duplicate answers, each group lists names in their original order
+def group_similar(answers, threshold=0.8):
+    signatures = {name: signature(advice) for name, advice in answers.items()}
+    groups = []
+    for name in answers:
+        for group in groups:
+            if similarity(signatures[group[0]], signatures[name]) >= threshold:
+                group.append(name)
+                break
+        else:
+            groups.append([name])
+    return groups
@@ -0,0 +1,104 @@
+import threading
+from concurrent.futures import Future
+
+
+# Concurrent callers with the same key share one running call instead of each making their own
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.joined = 0
+
+    def run(self, key, fn, *args):
+        with self._lock:
+            future = self._calls.get(key)
+            owner = future is None
+            if owner:
+                future = self._calls[key] = Future()
+            else:
+                self.joined += 1
+        if not owner:
+            return future.result()
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+        future.set_result(result)
+        return result
+
+
+# One upstream stream read by several callers: chunks are kept so a late reader replays them,
+# and whichever reader runs out of chunks pulls the next one, so no reader depends on another staying
+class SharedStream:
+    def __init__(self, source):
+        self.source = source
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self._lock = threading.Lock()
+        self._pull_lock = threading.Lock()
+
+    def read(self):
+        i = 0
+        while True:
+            with self._lock:
+                chunk = self.chunks[i] if i < len(self.chunks) else None
+                done = self.done
+            if chunk is not None:
+                i += 1
+                yield chunk
+                continue
+            if done:
+                if self.error is not None:
+                    raise self.error
+                return
+            with self._pull_lock:
+                with self._lock:
+                    if i < len(self.chunks) or self.done:
+                        continue
+                try:
+                    chunk = next(self.source)
+                except StopIteration:
+                    with self._lock:
+                        self.done = True
+                    continue
+                except Exception as e:
+                    with self._lock:
+                        self.done = True
+                        self.error = e
+                    continue
+                with self._lock:
+                    self.chunks.append(chunk)
+
+
+# Concurrent callers with the same key share one running stream, each reading all of it from the start
+# The upstream stream is closed once its last reader stops early
+class StreamFlight:
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+        self.joined = 0
+
+    def stream(self, key, fn, *args):
+        with self._lock:
+            shared = self._streams.get(key)
+            if shared is None:
+                shared = self._streams[key] = SharedStream(fn(*args))
+            else:
+                self.joined += 1
+            shared.readers += 1
+        try:
+            yield from shared.read()
+        finally:
+            with self._lock:
+                shared.readers -= 1
+                idle = shared.readers == 0
+                if (idle or shared.done) and self._streams.get(key) is shared:
+                    del self._streams[key]
+            if idle and not shared.done:
+                shared.source.close()
@@ -0,0 +1,64 @@
+import threading
+import time
+from collections import defaultdict, deque
+
+
+# Function to get the p-th percentile of a list of numbers, nearest rank
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+# Rolling window of recent calls per model, shared by the whole process
+# Each call is (when, seconds, completion tokens), failures have seconds None
+# Calls older than max_age seconds are forgotten, so a model that was slow a while ago gets another chance
+class ModelStats:
+    def __init__(self, window=200, max_age=600):
+        self.window = window
+        self.max_age = max_age
+        self._calls = defaultdict(lambda: deque(maxlen=self.window))
+        self._lock = threading.Lock()
+
+    def record(self, model, seconds, tokens=None):
+        with self._lock:
+            self._calls[model].append((time.monotonic(), seconds, tokens))
+
+    def record_failure(self, model):
+        with self._lock:
+            self._calls[model].append((time.monotonic(), None, None))
+
+    def _recent(self, model):
+        oldest = time.monotonic() - self.max_age
+        with self._lock:
+            return [call for call in self._calls[model] if call[0] >= oldest]
+
+    # Percentile of recent durations, None until min_samples calls were seen
+    def percentile(self, model, p, min_samples=20):
+        durations = [seconds for when, seconds, tokens in self._recent(model) if seconds is not None]
+        if len(durations) < min_samples:
+            return None
+        return percentile(durations, p)
+
+    # Recent p50/p95 latency, error rate and completion tokens per second of a model
+    # Each figure is None until min_samples calls it depends on were seen
+    def summary(self, model, min_samples=20):
+        calls = self._recent(model)
+        durations = [seconds for when, seconds, tokens in calls if seconds is not None]
+        timed = [(seconds, tokens) for when, seconds, tokens in calls if seconds and tokens]
+        enough = len(durations) >= min_samples
+        return {
+            "calls": len(calls),
+            "p50": percentile(durations, 50) if enough else None,
+            "p95": percentile(durations, 95) if enough else None,
+            "error_rate": (len(calls) - len(durations)) / len(calls) if len(calls) >= min_samples else None,
+            "tokens_per_sec": sum(tokens for seconds, tokens in timed) / sum(seconds for seconds, tokens in timed) if len(timed) >= min_samples else None,
+        }
+
+    def models(self):
+        with self._lock:
+            return [model for model, calls in self._calls.items() if calls]
+
+
+model_stats = ModelStats()
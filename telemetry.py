@@ -0,0 +1,139 @@
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+# Where finished spans go besides the run's trace: "" nowhere, "json" one JSON line per call appended to
+# path (stderr when empty), "otel" OpenTelemetry spans when opentelemetry-api is installed
+telemetry_settings = {
+    "export": os.getenv("KING_TELEMETRY", ""),
+    "path": os.getenv("KING_TELEMETRY_PATH", ""),
+}
+
+# Spans open on each thread, innermost last, so providers can annotate the call they run in
+_local = threading.local()
+_write_lock = threading.Lock()
+_otel = {}
+
+
+# One timed call: attributes hold model, role, queue_wait, ttfb, tokens, retries, cache_hit and error
+class Span:
+    def __init__(self, trace, name, **attributes):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.wall_start = time.time_ns()
+        self.end = None
+
+    def __enter__(self):
+        _stack().append(self)
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        _stack().remove(self)
+        if error is not None:
+            self.attributes["error"] = f"{kind.__name__}: {error}"
+        self.finish()
+        return False
+
+    def finish(self):
+        self.end = time.perf_counter()
+        duration = self.end - self.start
+        completion_tokens = self.attributes.get("completion_tokens")
+        # Generation speed counts from the first streamed token, answers that come in one piece from the end of the queue
+        generating = duration - (self.attributes.get("ttft") or 0) - self.attributes.get("queue_wait", 0)
+        if completion_tokens and generating > 0:
+            self.attributes["tokens_per_sec"] = completion_tokens / generating
+        self.trace.add(self)
+
+    def record(self):
+        return {
+            "trace_id": self.trace.trace_id,
+            "name": self.name,
+            "start": self.start - self.trace.start,
+            "duration": (self.end or time.perf_counter()) - self.start,
+            **self.attributes,
+        }
+
+
+# The spans of one council run, shared by the threads working on it
+class Trace:
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.start = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def span(self, name, **attributes):
+        return Span(self, name, **attributes)
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+        export(span)
+
+    # Finished spans as plain dicts in the order they started, start is seconds since the run started
+    def records(self):
+        with self._lock:
+            spans = list(self.spans)
+        return [span.record() for span in sorted(spans, key=lambda span: span.start)]
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+# Function to set attributes on the innermost span open on this thread, does nothing outside a span
+def annotate(**attributes):
+    stack = _stack()
+    if stack:
+        stack[-1].attributes.update(attributes)
+
+# Function to add to counters such as retries or queue_wait on the innermost span open on this thread
+def count(**amounts):
+    stack = _stack()
+    if stack:
+        for name, amount in amounts.items():
+            stack[-1].attributes[name] = stack[-1].attributes.get(name, 0) + amount
+
+# Function to note when something first happened in the call on this thread, such as its first byte
+# ("ttfb") or first streamed token ("ttft"), in seconds after the time spent queueing
+def mark(name):
+    stack = _stack()
+    if stack and stack[-1].attributes.get(name) is None:
+        span = stack[-1]
+        span.attributes[name] = time.perf_counter() - span.start - span.attributes.get("queue_wait", 0)
+
+# Function to send a finished span to the configured exporter
+def export(span):
+    if telemetry_settings["export"] == "otel" and _export_otel(span):
+        return
+    if telemetry_settings["export"] in ("json", "otel"):
+        line = json.dumps(span.record(), default=str)
+        with _write_lock:
+            if telemetry_settings["path"]:
+                with open(telemetry_settings["path"], "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+            else:
+                print(line, file=sys.stderr)
+
+# Function to export a span through OpenTelemetry, returns False when opentelemetry-api is not installed
+def _export_otel(span):
+    if "tracer" not in _otel:
+        try:
+            from opentelemetry import trace as otel_trace
+            _otel["tracer"] = otel_trace.get_tracer("theking")
+        except ImportError:
+            print("opentelemetry-api is not installed, exporting spans as JSON lines instead", file=sys.stderr)
+            _otel["tracer"] = None
+    if _otel["tracer"] is None:
+        return False
+    attributes = {f"king.{name}": value for name, value in span.attributes.items() if value is not None}
+    attributes["king.trace_id"] = span.trace.trace_id
+    otel_span = _otel["tracer"].start_span(span.name, start_time=span.wall_start, attributes=attributes)
+    otel_span.end(end_time=span.wall_start + int((span.end - span.start) * 1e9))
+    return True
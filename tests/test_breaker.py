@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from breaker import CircuitBreaker, CircuitOpenError
+
+
+def breaker(cooldown=0.05):
+    return CircuitBreaker({"failures": 2, "provider_failures": 4, "cooldown": cooldown})
+
+
+def test_model_circuit_opens_after_back_to_back_failures():
+    circuits = breaker()
+    circuits.record_failure("groq", "gemma-7b-it")
+    circuits.check("groq", "gemma-7b-it")
+    circuits.record_failure("groq", "gemma-7b-it")
+    with pytest.raises(CircuitOpenError) as refused:
+        circuits.check("groq", "gemma-7b-it")
+    assert refused.value.name == "groq/gemma-7b-it"
+    # Other models of the provider are still called
+    circuits.check("groq", "llama3-8b-8192")
+    assert not circuits.allows("groq", "gemma-7b-it")
+
+
+def test_success_resets_the_failure_count():
+    circuits = breaker()
+    circuits.record_failure("groq", "gemma-7b-it")
+    circuits.record_success("groq", "gemma-7b-it")
+    circuits.record_failure("groq", "gemma-7b-it")
+    circuits.check("groq", "gemma-7b-it")
+
+
+def test_provider_circuit_opens_across_models():
+    circuits = breaker()
+    for model in ("a", "b", "c", "d"):
+        circuits.record_failure("openai", model)
+    with pytest.raises(CircuitOpenError) as refused:
+        circuits.check("openai", "e")
+    assert refused.value.name == "openai"
+
+
+def test_half_open_probe_closes_or_reopens_the_circuit():
+    circuits = breaker()
+    for _ in range(2):
+        circuits.record_failure("groq", "gemma-7b-it")
+    time.sleep(0.06)
+    # One probe goes through after the cooldown, the next caller is refused until it reports back
+    circuits.check("groq", "gemma-7b-it")
+    with pytest.raises(CircuitOpenError):
+        circuits.check("groq", "gemma-7b-it")
+    circuits.record_failure("groq", "gemma-7b-it")
+    with pytest.raises(CircuitOpenError):
+        circuits.check("groq", "gemma-7b-it")
+    time.sleep(0.06)
+    circuits.check("groq", "gemma-7b-it")
+    circuits.record_success("groq", "gemma-7b-it")
+    circuits.check("groq", "gemma-7b-it")
+    assert circuits.open_circuits() == {}
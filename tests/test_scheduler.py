@@ -0,0 +1,54 @@
+import threading
+
+import pytest
+
+from scheduler import Node, run_graph
+
+
+def test_nodes_start_after_their_deps_and_get_their_results():
+    order = []
+    lock = threading.Lock()
+
+    def task(name, value):
+        def run(done, emit):
+            with lock:
+                order.append(name)
+            emit("ran", {"name": name})
+            return value + sum(done.values())
+
+        return run
+
+    nodes = [Node("a", task("a", 1)), Node("b", task("b", 2)), Node("c", task("c", 10), ["a", "b"])]
+    events = []
+    finished = []
+    results, seconds = run_graph(nodes, lambda event, data: events.append(data["name"]), lambda key, result: finished.append(key))
+    assert results == {"a": 1, "b": 2, "c": 13}
+    assert set(seconds) == {"a", "b", "c"}
+    assert order[-1] == "c"
+    assert finished[-1] == "c"
+    assert sorted(events) == ["a", "b", "c"]
+
+
+def test_on_done_runs_before_dependents_start():
+    seen = {}
+    nodes = [Node("a", lambda done, emit: "first"), Node("b", lambda done, emit: seen.get("a"), ["a"])]
+    results, _ = run_graph(nodes, on_done=lambda key, result: seen.__setitem__(key, result))
+    assert results["b"] == "first"
+
+
+def test_failing_node_stops_the_run():
+    ran = []
+
+    def fail(done, emit):
+        raise RuntimeError("node failed")
+
+    nodes = [Node("a", fail), Node("b", lambda done, emit: ran.append("b"), ["a"])]
+    with pytest.raises(RuntimeError, match="node failed"):
+        run_graph(nodes)
+    assert ran == []
+
+
+def test_missing_or_circular_dependencies_are_reported():
+    nodes = [Node("a", lambda done, emit: 1, ["b"]), Node("b", lambda done, emit: 2, ["a"])]
+    with pytest.raises(ValueError, match="circular"):
+        run_graph(nodes)
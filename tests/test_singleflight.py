@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight, StreamFlight
+
+
+# A stub upstream stream that notes how far it was read and whether it was closed
+class Source:
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+        self.pulled = 0
+        self.closed = False
+
+    def __call__(self):
+        try:
+            for chunk in self.chunks:
+                self.pulled += 1
+                yield chunk
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.closed = True
+
+
+def test_late_reader_replays_chunks_from_the_start():
+    flight = StreamFlight()
+    source = Source(["a", "b", "c"])
+    first = flight.stream("key", source)
+    assert [next(first), next(first)] == ["a", "b"]
+    late = flight.stream("key", source)
+    assert list(late) == ["a", "b", "c"]
+    assert list(first) == ["c"]
+    assert source.pulled == 3
+    assert flight.joined == 1
+
+
+def test_last_early_reader_closes_the_source():
+    flight = StreamFlight()
+    source = Source(["a", "b", "c"])
+    first = flight.stream("key", source)
+    second = flight.stream("key", source)
+    next(first)
+    next(second)
+    first.close()
+    assert not source.closed
+    second.close()
+    assert source.closed
+    # The stopped stream is forgotten, a new reader starts a new one
+    third = flight.stream("key", Source(["x"]))
+    assert list(third) == ["x"]
+
+
+def test_error_reaches_every_reader():
+    flight = StreamFlight()
+    source = Source(["a"], RuntimeError("upstream failed"))
+    readers = [flight.stream("key", source), flight.stream("key", source)]
+    for reader in readers:
+        assert next(reader) == "a"
+    for reader in readers:
+        with pytest.raises(RuntimeError, match="upstream failed"):
+            next(reader)
+
+
+def test_different_keys_do_not_share():
+    flight = StreamFlight()
+    assert list(flight.stream("one", Source(["a"]))) == ["a"]
+    assert list(flight.stream("two", Source(["b"]))) == ["b"]
+    assert flight.joined == 0
+
+
+# Calls fn on several threads at once, returning what each got back or raised
+def call_together(flight, fn, callers):
+    entered = threading.Event()
+    release = threading.Event()
+    results = [None] * callers
+
+    def blocking():
+        entered.set()
+        release.wait(5)
+        return fn()
+
+    def call(i):
+        try:
+            results[i] = flight.run("key", blocking)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+    threads[0].start()
+    entered.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # Every other caller has joined the first one's call before it is let go
+    while flight.joined < callers - 1:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_concurrent_calls_share_one_result():
+    flight = SingleFlight()
+    calls = []
+    results = call_together(flight, lambda: calls.append(1) or "answer", 3)
+    assert results == ["answer"] * 3
+    assert len(calls) == 1
+
+
+def test_shared_call_error_reaches_every_caller():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError("bad request")
+
+    results = call_together(flight, fail, 3)
+    assert all(isinstance(result, ValueError) for result in results)
+    # The failed call is forgotten, the next caller makes its own
+    assert flight.run("key", lambda: "retried") == "retried"